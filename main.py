@@ -14,9 +14,13 @@ from discord.ext import commands
 from discord.ext.commands.core import _convert_to_bool
 
 from src.checks.message_check import check_reply, question_check
+from src.helpers.graph_helper import init_render_worker, ping_render_worker
 from src.helpers.help import UtilsHelp
+from src.helpers.metrics_helper import event_handler_latency, gateway_events
 from src.helpers.mongo_helper import MongoDB
+from src.helpers.pool_helper import PoolBusy, WorkerPool
 from src.helpers.storage_helper import DataHelper
+from src.helpers.sync_mongo_helper import init_worker, ping_worker
 from src.storage import config
 from src.storage.token import token  # token.py is just one variable - token = "token"
 
@@ -40,6 +44,33 @@ class UtilsBot(commands.Bot):
         self.mongo: Union[MongoDB, None] = None
         self.restart_waiter_lock = asyncio.Lock()
         self.restart_waiters = 0
+        self.analytics_pool = WorkerPool("analytics", config.analytics_pool_size, initializer=init_worker,
+                                         health_check=ping_worker)
+        self.render_pool = WorkerPool("render", config.render_pool_size, initializer=init_render_worker,
+                                      health_check=ping_render_worker, max_queue=config.render_pool_max_queue,
+                                      reserved=config.render_pool_reserved)
+
+    def dispatch(self, event_name, *args, **kwargs):
+        gateway_events.inc(event=event_name)
+        super().dispatch(event_name, *args, **kwargs)
+
+    # Every listener runs through _run_event, so timing it here gives the latency of each cog's handlers.
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            await super()._run_event(coro, event_name, *args, **kwargs)
+        finally:
+            cog = getattr(coro, "__self__", None)
+            event_handler_latency.observe(time.perf_counter() - start, event=event_name,
+                                          cog="Bot" if cog is None else type(cog).__name__)
+
+    async def close(self):
+        db_maintainer = self.get_cog("DBMaintainer")
+        if db_maintainer is not None:
+            await db_maintainer.drain()
+        self.analytics_pool.shutdown()
+        self.render_pool.shutdown()
+        await super().close()
 
     async def get_guild_prefix(self, guild: discord.Guild):
         if self.mongo is None:
@@ -167,6 +198,8 @@ def get_bot():
         for extension_name, extension in bot.extensions.items():
             bot.unload_extension(extension_name)
         bot.mongo = MongoDB()
+        bot.analytics_pool.start()
+        bot.render_pool.start()
         bot.guild = bot.get_guild(config.monkey_guild_id)
         bot.error_channel = bot.get_channel(config.error_channel_id)
         for extension_name in config.extensions:
@@ -209,6 +242,10 @@ def get_bot():
                                                                    "have permission to send "
                                                                    "messages in that channel!".format(ctx.command)))
                 return
+            if isinstance(error.original, PoolBusy):
+                await ctx.reply(embed=bot.create_error_embed("I'm busy drawing lots of graphs right now, "
+                                                             "try again in a moment!"))
+                return
             print(type(error.original))
         if isinstance(error, commands.BotMissingPermissions):
             missing = [perm.replace('_', ' ').replace('guild', 'server').title() for perm in error.missing_perms]
@@ -8,6 +8,7 @@ from aiohttp import web
 from discord.ext import commands
 
 from main import UtilsBot
+from src.helpers.metrics_helper import metrics
 from src.storage import config
 
 
@@ -19,7 +20,7 @@ class API(commands.Cog):
         app = web.Application()
         app.add_routes([web.post('/speak', self.handle_speak_message), web.post('/disconnect', self.handle_disconnect),
                         web.get('/check_access', self.check_access), web.get('/avatar_urls', self.avatar_urls),
-                        web.get('/regen_img/{data}', self.regen_image)])
+                        web.get('/regen_img/{data}', self.regen_image), web.get('/metrics', self.metrics)])
         # noinspection PyProtectedMember
         self.bot.loop.create_task(self.start_site(app))
 
@@ -30,6 +31,10 @@ class API(commands.Cog):
         self.bot.loop.create_task(site.start())
         return
 
+    # noinspection PyUnusedLocal
+    async def metrics(self, request: web.Request):
+        return web.Response(text=metrics.render(), content_type="text/plain")
+
     def find_autocorrect(self, word):
         suggestions = self.speller.suggest(word)
         return suggestions[0] if len(suggestions) > 0 else word
@@ -1,21 +1,60 @@
+import time
+
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
+from pymongo.errors import PyMongoError
 
 from main import UtilsBot
+from src.checks.user_check import is_owner
+from src.helpers.buffer_helper import DeleteBuffer, MessageBuffer
+from src.helpers.metrics_helper import metrics
+from src.helpers.spool_helper import MessageSpool
+from src.storage import config
 
 
 class DBMaintainer(commands.Cog):
     def __init__(self, bot: UtilsBot):
         self.bot = bot
+        self.spool = MessageSpool(self.bot.mongo)
+        self.message_buffer = MessageBuffer(self.bot.mongo, self.spool)
+        self.delete_buffer = DeleteBuffer(self.bot.mongo, self.message_buffer)
+        self.last_sync_duration = None
+        queue_depth = metrics.gauge("utils_buffer_queue_depth", "Writes waiting in a buffer.", ("buffer",))
+        queue_depth.set_function(lambda: self.message_buffer.queue_depth, buffer="messages")
+        queue_depth.set_function(lambda: self.delete_buffer.queue_depth, buffer="deleted")
+        metrics.gauge("utils_spool_segments", "Spool segments waiting to be replayed.").set_function(
+            lambda: len(self.spool.segment_paths()))
         self.bot.loop.create_task(self.post_init())
+        self.replay_spool.start()
+
+    def cog_unload(self):
+        self.replay_spool.cancel()
+        self.bot.loop.create_task(self.drain())
+
+    async def drain(self):
+        await self.message_buffer.drain()
+        await self.delete_buffer.drain()
+
+    @tasks.loop(seconds=config.spool_replay_interval, count=None)
+    async def replay_spool(self):
+        if not self.spool.active:
+            return
+        try:
+            await self.bot.mongo.client.admin.command("ping")
+            replayed = await self.spool.replay()
+        except PyMongoError:
+            return
+        print(f"Replayed {replayed} spooled records into Mongo.")
 
     async def post_init(self):
+        self.bot.loop.create_task(self.bot.mongo.ensure_indexes())
+        start = time.perf_counter()
+        written = 0
         for guild in self.bot.guilds:
-            await self.bot.mongo.insert_guild(guild)
-            for channel in guild.text_channels:
-                await self.bot.mongo.insert_channel(channel)
-            for member in guild.members:
-                await self.bot.mongo.insert_member(member)
+            written += await self.bot.mongo.bulk_sync_guild(guild, guild.text_channels, guild.members)
+        self.last_sync_duration = time.perf_counter() - start
+        print(f"Synced {len(self.bot.guilds)} guilds in {self.last_sync_duration:.2f}s "
+              f"({written} documents written).")
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -24,25 +63,44 @@ class DBMaintainer(commands.Cog):
             return
         if bool(message.flags.value & 1 << 6):  # If message is ephemeral
             return
-        await self.bot.mongo.insert_message(message)
+        message_document, channel_lookup = self.bot.mongo.prepare_message(message)
+        if channel_lookup is not None:
+            self.bot.loop.create_task(self.add_when_checked(message, message_document, channel_lookup))
+        elif message_document is not None:
+            self.add_message(message, message_document)
+
+    def add_message(self, message, message_document):
+        self.message_buffer.add(message_document)
+        statistics = self.bot.get_cog("Statistics")
+        if statistics is not None:
+            statistics.scores.add_message(message)
+
+    async def add_when_checked(self, message, message_document, channel_lookup):
+        """Stores a message once its channel's nostore flag has been read. If Mongo couldn't be asked, the message
+        is spooled as unchecked, and the flag is checked when the spool is replayed."""
+        nostore = await channel_lookup
+        if nostore is None:
+            await self.spool.append("unchecked", [message_document])
+        elif not nostore:
+            self.add_message(message, message_document)
 
     @commands.Cog.listener()
     async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
-        await self.bot.mongo.discord_db.messages.update_one({"_id": payload.message_id},
-                                                            {'$set': {"deleted": True}})
+        self.delete_buffer.add([payload.message_id])
 
     @commands.Cog.listener()
     async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
-        message_ids = list(payload.message_ids)
-        await self.bot.mongo.discord_db.messages.update_many({"_id": {'$in': message_ids}},
-                                                             {'$set': {"deleted": True}})
+        self.delete_buffer.add(payload.message_ids)
 
     @commands.Cog.listener()
     async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
-        await self.bot.mongo.message_edit(payload)
+        edit = self.bot.mongo.edit_from_payload(payload)
+        if edit is not None:
+            await self.message_buffer.edit(edit)
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member):
+        self.bot.mongo.forget_member(member.guild.id, member.id)
         await self.bot.mongo.discord_db.members.update_one({"_id": {"user_id": member.id, "guild_id": member.guild.id}},
                                                            {'$set': {"deleted": True}})
 
@@ -68,6 +126,7 @@ class DBMaintainer(commands.Cog):
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel):
         if isinstance(channel, discord.TextChannel):
+            self.bot.mongo.forget_channel(channel.id)
             await self.bot.mongo.discord_db.channels.update_one({"_id": channel.id},
                                                                 {'$set': {"deleted": True}})
 
@@ -78,18 +137,75 @@ class DBMaintainer(commands.Cog):
 
     @commands.Cog.listener()
     async def on_guild_join(self, guild):
-        await self.bot.mongo.insert_guild(guild)
+        start = time.perf_counter()
         channels = await guild.fetch_channels()
-        for channel in channels:
-            if isinstance(channel, discord.TextChannel):
-                await self.bot.mongo.insert_channel(channel)
-        async for member in guild.fetch_members(limit=None):
-            await self.bot.mongo.insert_member(member)
+        members = await guild.fetch_members(limit=None).flatten()
+        written = await self.bot.mongo.bulk_sync_guild(guild, channels, members)
+        print(f"Synced new guild {guild.name} in {time.perf_counter() - start:.2f}s ({written} documents written).")
 
     @commands.Cog.listener()
     async def on_guild_update(self, _, guild):
         await self.bot.mongo.insert_guild(guild)
 
+    @commands.command()
+    @is_owner()
+    async def ingest_status(self, ctx):
+        embed = self.bot.create_completed_embed("Message Ingestion",
+                                                f"Queue depth: {self.message_buffer.queue_depth}\n"
+                                                f"Last flush: {self.message_buffer.last_flush_size} messages in "
+                                                f"{self.message_buffer.last_flush_latency * 1000:.1f}ms\n"
+                                                f"Total flushed: {self.message_buffer.total_flushed:,}\n"
+                                                f"Pending deletes: {self.delete_buffer.queue_depth}\n"
+                                                f"Last delete flush: {self.delete_buffer.last_flush_size} messages "
+                                                f"in {self.delete_buffer.last_flush_latency * 1000:.1f}ms")
+        if self.spool.active:
+            embed.add_field(name="Spool", value=f"{len(self.spool.segment_paths())} segments waiting for Mongo")
+        if self.last_sync_duration is not None:
+            embed.add_field(name="Startup Sync", value=f"{self.last_sync_duration:.2f}s")
+        await ctx.reply(embed=embed)
+
+    @commands.command()
+    @is_owner()
+    async def index_stats(self, ctx):
+        sent = await ctx.reply(embed=self.bot.create_processing_embed("Checking indexes...",
+                                                                      "Collecting index usage and query plans."))
+        problems = await self.bot.mongo.ensure_indexes()
+        usage, collection_scans = await self.bot.mongo.index_report()
+        embed = discord.Embed(title="Index Usage", colour=discord.Colour.green())
+        for collection_name, index_usage in usage.items():
+            value = "\n".join(f"{name}: {ops:,}" for name, ops in index_usage.items()) or "No indexes."
+            embed.add_field(name=collection_name, value=value[:1024], inline=False)
+        if len(collection_scans) > 0:
+            embed.colour = discord.Colour.red()
+            embed.add_field(name="Collection Scans", value="\n".join(collection_scans)[:1024], inline=False)
+        if len(problems) > 0:
+            embed.colour = discord.Colour.red()
+            embed.add_field(name="Problems", value="\n".join(problems)[:1024], inline=False)
+        await sent.edit(embed=embed)
+
+    @commands.command()
+    @is_owner()
+    async def compact_messages(self, ctx):
+        sent = await ctx.reply(embed=self.bot.create_processing_embed("Compacting messages...",
+                                                                      "Starting migration..."))
+        last_id = 0
+        compacted = 0
+        checked = 0
+        last_edit = time.perf_counter()
+        while True:
+            last_id, modified = await self.bot.mongo.compact_message_batch(last_id, config.compact_batch_size)
+            if last_id is None:
+                break
+            compacted += modified
+            checked += config.compact_batch_size
+            if time.perf_counter() - last_edit > 5:
+                await sent.edit(embed=self.bot.create_processing_embed("Compacting messages...",
+                                                                       f"Checked about {checked:,} messages, "
+                                                                       f"compacted {compacted:,}."))
+                last_edit = time.perf_counter()
+        await sent.edit(embed=self.bot.create_completed_embed("Compacted messages!",
+                                                              f"Compacted {compacted:,} message documents."))
+
 
 def setup(bot: UtilsBot):
     cog = DBMaintainer(bot)
@@ -4,6 +4,7 @@ from discord.ext import commands, tasks
 from typing import Optional
 from main import UtilsBot
 from src.checks.role_check import is_staff
+from src.helpers.mongo_helper import NOT_DELETED
 
 
 class DynamicChannels(commands.Cog):
@@ -40,7 +41,7 @@ class DynamicChannels(commands.Cog):
             except (IndexError, ValueError):
                 old_count = 0
             count = await self.bot.mongo.discord_db.messages.count_documents({"guild_id": channel.guild.id,
-                                                                              "deleted": False})
+                                                                              "deleted": NOT_DELETED})
             if count - old_count > count / 200:
                 print(f"Updating messages. {count - old_count = } and {count / 200 = }")
                 await channel.edit(name=f"Messages: {count:,}")
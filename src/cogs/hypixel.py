@@ -1,8 +1,6 @@
-import concurrent.futures
 import inspect
 import secrets
 import traceback
-from functools import partial
 from typing import Optional
 
 import discord
@@ -191,12 +189,11 @@ class Hypixel(commands.Cog):
                     self.head_images[user_uuid] = (head_image, datetime.datetime.now())
                     return head_image
 
-    async def get_expanded_player(self, user_uuid, pool, reset=False, prioritize=False):
+    async def get_expanded_player(self, user_uuid, reset=False, prioritize=False):
         """
 
         :param prioritize: Whether to prioritize this request (normally, if it is a user command).
         :param user_uuid: The minecraft uuid of the player in question.
-        :param pool: Instance of concurrent.futures.ProcessPoolExecutor
         :param reset: Whether to still update the embeds (later) even if the image hasn't changed
         :return: player dictionary with player["file"] being the generated image.
         """
@@ -208,8 +205,10 @@ class Hypixel(commands.Cog):
             player = await self.get_user_stats(user_uuid, prioritize)
         self.user_stats_cache[user_uuid] = (player, datetime.datetime.now())
         player["head_image"] = await self.get_head_image(player["uuid"])
-        # Run the get_file_for_member function in another process and await its completion
-        member_file = await self.bot.loop.run_in_executor(pool, partial(get_file_for_member, player))
+        # Run the get_file_for_member function in the render pool and await its completion. User commands are turned
+        # away if the pool is full, background updates wait their turn.
+        render = self.bot.render_pool.run if prioritize else self.bot.render_pool.run_when_free
+        member_file = await render(get_file_for_member, player)
         last_file = None
         if not reset:
             # Check whether the image has changed.
@@ -218,7 +217,7 @@ class Hypixel(commands.Cog):
             if last_file is None:
                 same_file = False
             else:
-                same_file = await self.bot.loop.run_in_executor(pool, partial(are_equal, last_file, member_file))
+                same_file = await render(are_equal, last_file, member_file)
                 if same_file:
                     print(f"Player {player['name']} has not changed.")
                     member_file.close()
@@ -280,10 +279,8 @@ class Hypixel(commands.Cog):
             valid = await self.check_valid_player(uuid)
             if not valid:
                 return web.Response(status=404)
-            # Calls get_expanded_player to get the player dictionary, with a new ProcessPoolExecutor to put the process
-            # in, separate from the embeds so it can execute independently.
-            with concurrent.futures.ProcessPoolExecutor() as pool:
-                player = await self.get_expanded_player(uuid, pool, True)
+            # Calls get_expanded_player to get the player dictionary, with the image drawn in the render pool.
+            player = await self.get_expanded_player(uuid, True)
             data = player["file"]
             last_timestamp = datetime.datetime.now()
             # Caches the image and timestamp
@@ -332,9 +329,8 @@ class Hypixel(commands.Cog):
                     await ctx.reply(embed=self.bot.create_error_embed("That user hasn't played on hypixel. Get them to "
                                                                       "log in (and out!) at least once."))
                     return
-                with concurrent.futures.ProcessPoolExecutor() as pool:
-                    print("running get expanded player")
-                    player = await self.get_expanded_player(uuid, pool, True, prioritize=True)
+                print("running get expanded player")
+                player = await self.get_expanded_player(uuid, True, prioritize=True)
                 print("expanded player done")
                 data = player["file"]
                 self.user_to_files[username.lower()] = (data, datetime.datetime.now())
@@ -563,8 +559,8 @@ class Hypixel(commands.Cog):
                     await editable_messages[i].edit(embed=embed)
                 i += 1
 
-    async def get_with_storage(self, player_dictionary, pool, reset):
-        player_data = await self.get_expanded_player(player_dictionary.get("_id"), pool, reset)
+    async def get_with_storage(self, player_dictionary, reset):
+        player_data = await self.get_expanded_player(player_dictionary.get("_id"), reset)
         stats = player_data.get("stats")
         bedwars = stats.get("Bedwars")
         uuid = player_data.get("uuid")
@@ -631,15 +627,13 @@ class Hypixel(commands.Cog):
             # Completely refresh the embeds every 10 minutes. Just so last update time isn't more than 10 mins ago.
             reset = (now - self.last_reset).total_seconds() > 600
             # Fetches hypixel data in the main thread, then
-            # runs a pool of processes (machine core count simultaneously) to generate the player images.
+            # generates the player images in the render pool.
             member_futures = []
             if reset:
                 self.last_reset = datetime.datetime.now()
-            with concurrent.futures.ProcessPoolExecutor() as pool:
-                for player_dict in all_players:
-                    member_futures.append(self.bot.loop.create_task(self.get_with_storage(player_dict, pool,
-                                                                                          reset)))
-                member_dicts = await asyncio.gather(*member_futures)
+            for player_dict in all_players:
+                member_futures.append(self.bot.loop.create_task(self.get_with_storage(player_dict, reset)))
+            member_dicts = await asyncio.gather(*member_futures)
             # Sort offline members before online members, regardless of threat index.
             offline_members = [member for member in member_dicts if not member["online"]]
             online_members = [member for member in member_dicts if member["online"]]
@@ -934,9 +928,8 @@ class Hypixel(commands.Cog):
             await ctx.reply(embed=self.bot.create_error_embed(f"I can't graph {username}'s data over time. I have "
                                                               f"only tracked one game!\n\nGo play some more bedwars!"))
             return
-        with concurrent.futures.ProcessPoolExecutor() as pool:
-            data = await self.bot.loop.run_in_executor(pool, partial(plot_stats, all_important, x_label="Games",
-                                                                     y_label=nice_name, smooth=self.smooth_mode))
+        data = await self.bot.render_pool.run(plot_stats, all_important, x_label="Games", y_label=nice_name,
+                                              smooth=self.smooth_mode)
         file = BytesIO(data)
         discord_file = discord.File(file, filename="image.png")
         embed = discord.Embed(title=f"{username}'s {nice_name} over the last {len(all_important) - 1} games")
@@ -997,9 +990,7 @@ class Hypixel(commands.Cog):
                                                               f"tracked one game! \nGo play some more bedwars!"))
             return
         all_important = [getattr(x, attribute) for x in all_stats]
-        with concurrent.futures.ProcessPoolExecutor() as pool:
-            games_estimated = await self.bot.loop.run_in_executor(pool, partial(extrapolate_threat_index,
-                                                                                all_important, amount))
+        games_estimated = await self.bot.render_pool.run(extrapolate_threat_index, all_important, amount)
         if games_estimated == float("inf"):
             games_estimated = str("Infinite")
         else:
@@ -1017,8 +1008,8 @@ class Hypixel(commands.Cog):
 
         await ctx.reply(embed=embed)
 
-    async def get_y_function(self, pool, input_threat_indexes: list[int]):
-        a, b, c, d = await self.bot.loop.run_in_executor(pool, partial(run_curve_fit, input_threat_indexes))
+    async def get_y_function(self, input_threat_indexes: list[int]):
+        a, b, c, d = await self.bot.render_pool.run(run_curve_fit, input_threat_indexes)
 
         def fit_function(x):
             return (a ** (x * b + c)) + d
@@ -1034,14 +1025,11 @@ class Hypixel(commands.Cog):
                                                               f"tracked one game! \nGo play some more bedwars!"))
             return
         all_important = [getattr(x, attribute) for x in all_stats]
-        with concurrent.futures.ProcessPoolExecutor() as pool:
-            y_func = await self.get_y_function(pool, all_important)
-            extrapolate_max = int(round(0.5 * len(all_important))) - 1
-            values = numpy.arange(0, len(all_important) + extrapolate_max, 1)
-            data = await self.bot.loop.run_in_executor(pool, partial(plot_and_extrapolate, all_important,
-                                                                     y_func(values),
-                                                                     x_label="Games", y_label=pretty_name,
-                                                                     smooth=self.smooth_mode))
+        y_func = await self.get_y_function(all_important)
+        extrapolate_max = int(round(0.5 * len(all_important))) - 1
+        values = numpy.arange(0, len(all_important) + extrapolate_max, 1)
+        data = await self.bot.render_pool.run(plot_and_extrapolate, all_important, y_func(values), x_label="Games",
+                                              y_label=pretty_name, smooth=self.smooth_mode)
         file = BytesIO(data)
         discord_file = discord.File(file, "image.png")
         embed = discord.Embed(title=f"Future Prediction for {username}'s {pretty_name}")
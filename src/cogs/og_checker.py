@@ -8,6 +8,7 @@ from typing import Optional
 
 from main import UtilsBot
 from src.checks.role_check import is_high_staff
+from src.helpers.mongo_helper import NOT_DELETED
 from src.helpers.storage_helper import DataHelper
 from src.checks.user_check import is_owner
 
@@ -44,7 +45,7 @@ class OGCog(commands.Cog):
         message_time = None
         earliest_message = await self.bot.mongo.discord_db.messages.find_one({"user_id": member.id,
                                                                               "guild_id": ctx.guild.id,
-                                                                              "deleted": False},
+                                                                              "deleted": NOT_DELETED},
                                                                              sort=[("created_at", pymongo.ASCENDING)])
         if earliest_message is not None:
             message_time = earliest_message.get("created_at").replace(tzinfo=datetime.timezone.utc)
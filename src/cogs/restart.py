@@ -86,6 +86,9 @@ class Restart(commands.Cog):
         await message.edit(embed=self.bot.create_processing_embed("Waiting on restart tasks...",
                                                                   "Waiting on restart tasks to finish up then "
                                                                   "restarting..."))
+        db_maintainer = self.bot.get_cog("DBMaintainer")
+        if db_maintainer is not None:
+            await db_maintainer.drain()
         try:
             self.bot.restart_event.set()
             await asyncio.sleep(0.5)
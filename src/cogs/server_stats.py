@@ -1,22 +1,29 @@
 import asyncio
-import concurrent.futures
 import datetime
 from functools import partial
 from io import BytesIO
+from traceback import format_exc
 from typing import Optional
 
 import aiohttp
 import aiohttp.client_exceptions
 import unidecode
 from discord.ext import commands, tasks
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError
 
 from main import UtilsBot
 from src.checks.role_check import is_high_staff, is_staff
 from src.checks.user_check import is_owner
 from src.helpers.api_helper import *
-from src.helpers.graph_helper import pie_chart_from_amount_and_labels, file_from_timestamps
+from src.helpers.backfill_helper import BackfillProgress, BackfillScheduler
+from src.helpers.graph_cache_helper import GraphCache, graph_key
+from src.helpers.graph_helper import pie_chart_from_amount_and_labels, file_from_counts, file_from_shared_timestamps
+from src.helpers.mongo_helper import DATE_TRUNC_UNITS, NOT_DELETED
+from src.helpers.name_helper import NameResolver
+from src.helpers.score_helper import SCORE_WINDOW, ScoreEngine, week_start
 from src.helpers.storage_helper import DataHelper
-from src.helpers.sync_mongo_helper import get_guild_score, get_user_score
+from src.helpers.timestamp_helper import SharedTimestamps
 from src.storage import config
 
 exceptions = (asyncio.exceptions.TimeoutError, aiohttp.client_exceptions.ServerDisconnectedError,
@@ -35,11 +42,52 @@ class Statistics(commands.Cog):
         self.last_update = self.bot.create_processing_embed("Working...", "Starting processing!")
         self.last_ping = datetime.datetime.now()
         self.active_channel_ids = []
-        self.running = False
         self.channel_lock = asyncio.Lock()
+        self.backfill = BackfillScheduler(self.live_busy)
+        self.progress = BackfillProgress()
+        self.scores = ScoreEngine(self.bot)
+        self.names = NameResolver(self.bot)
+        self.graphs = GraphCache()
+        self.progress_task = self.bot.loop.create_task(self.update_embeds())
         self.update_motw.start()
+        self.save_progress.start()
+        self.recount_rollups.start()
         self.bot.loop.create_task(self.startup_check())
 
+    def cog_unload(self):
+        self.backfill.stop()
+        self.progress_task.cancel()
+        self.save_progress.cancel()
+        self.recount_rollups.cancel()
+        self.bot.loop.create_task(self.persist_progress())
+
+    def live_busy(self):
+        db_maintainer = self.bot.get_cog("DBMaintainer")
+        if db_maintainer is None:
+            return False
+        message_buffer = db_maintainer.message_buffer
+        if message_buffer.message_rate > config.backfill_live_rate:
+            return True
+        # The last flush's latency only counts while there's something waiting, or a slow flush long ago would hold
+        # back-fill up forever.
+        return message_buffer.queue_depth > 0 and message_buffer.last_flush_latency > config.backfill_live_flush_latency
+
+    async def queue_channel(self, channel: discord.TextChannel):
+        checkpoint = await self.bot.mongo.get_backfill_checkpoint(channel.id)
+        message_time = channel.created_at
+        if checkpoint is not None and checkpoint.get("last_id"):
+            message_time = discord.utils.snowflake_time(checkpoint.get("last_id"))
+        if channel.last_message_id is None:
+            latest_time = datetime.datetime.utcnow()
+        else:
+            latest_time = discord.utils.snowflake_time(channel.last_message_id)
+        # Message counts aren't known up front, so the time left between the checkpoint and the channel's latest
+        # message stands in for them.
+        estimated_remaining = max((latest_time - message_time).total_seconds(), 0)
+        if self.backfill.submit(channel.guild.id, channel.id, estimated_remaining,
+                                partial(self.load_channel, channel)):
+            self.progress.publish(channel, channel.created_at, message_time, latest_time)
+
     @commands.command()
     @is_owner()
     async def add_discrims(self, ctx):
@@ -57,144 +105,175 @@ class Statistics(commands.Cog):
                                                                                          "discriminator": discriminator}})
         await ctx.reply("Done.")
 
+    @commands.command()
+    @is_owner()
+    async def backfill_rollups(self, ctx, guild_id: Optional[int] = None):
+        if guild_id is None:
+            guild_id = ctx.guild.id
+        sent = await ctx.reply(embed=self.bot.create_processing_embed("Building rollups",
+                                                                      "Counting every stored message..."))
+        await self.bot.mongo.backfill_rollups(guild_id)
+        await sent.edit(embed=self.bot.create_completed_embed("Rollups built!",
+                                                              "stats and server_stats now read from them."))
+
+    @tasks.loop(seconds=config.rollup_recount_interval, count=None)
+    async def recount_rollups(self):
+        """Counts the last few full days of every built guild's rollups again. Today is left alone, since it's still
+        getting messages, so its counts can stay a little low until it's over."""
+        today = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        since = today - datetime.timedelta(days=config.rollup_recount_days)
+        for guild in self.bot.guilds:
+            try:
+                if await self.bot.mongo.rollups_ready(guild.id):
+                    await self.bot.mongo.recount_rollups(guild.id, since, today)
+            except PyMongoError as e:
+                print(f"Couldn't recount message rollups for guild {guild.id}: {e}")
+
     async def startup_check(self):
-        query = self.bot.mongo.discord_db.loading_stats.find({"active": True})
+        status_documents = []
+        query = self.bot.mongo.discord_db.loading_stats.find({"$or": [{"active": True},
+                                                                      {"sent_message_id": {"$ne": None}}]})
         async for channel_document in query:
+            if channel_document.get("sent_message_id") is not None:
+                status_documents.append(channel_document)
+            if not channel_document.get("active"):
+                continue
             channel = self.bot.get_channel(channel_document.get("_id"))
-            sent_message_id = channel_document.get("sent_message_id", None)
-            self.bot.loop.create_task(self.load_channel(channel, sent_message_id))
-        if not self.running:
-            self.bot.loop.create_task(self.update_embeds())
+            if channel is None:
+                continue
+            await self.queue_channel(channel)
+        for status_document in status_documents:
+            guild_id = status_document.get("guild_id")
+            self.progress.set_status_message(guild_id, status_document.get("_id"),
+                                             status_document.get("sent_message_id"))
+            self.progress.touch(guild_id)
 
     async def update_embeds(self):
-        self.running = True
-        pipeline = [
-            {
-                "$project": {"_id": "$guild_id"}
-            }
-        ]
-        aggregation = self.bot.mongo.discord_db.loading_stats.aggregate(pipeline=pipeline)
-        unique_guild_ids = set(x.get("_id") for x in await aggregation.to_list(length=None))
-        done_guild_ids = []
-        if len(unique_guild_ids) == 0:
-            self.running = False
-            return
         while True:
-            for guild_id in unique_guild_ids:
-                lowest_percent = 100
-                sent_message_id = None
-                sent_message_channel_id = None
-                query = self.bot.mongo.discord_db.loading_stats.find({"guild_id": guild_id})
-                channel_documents = await query.to_list(length=None)
-                for channel_document in channel_documents:
-                    possible_sent = channel_document.get("sent_message_id", None)
-                    if possible_sent is not None:
-                        sent_message_id = possible_sent
-                        sent_message_channel_id = channel_document.get("_id")
-                    if not channel_document.get("active"):
-                        continue
-                    latest_time = channel_document.get("latest_time")
-                    percent = 1 - (
-                            (latest_time - channel_document.get("message_time")).total_seconds()
-                            /
-                            (latest_time - channel_document.get("earliest_time")).total_seconds())
-                    percent = percent * 100
-                    if percent < lowest_percent:
-                        lowest_percent = percent
-                if sent_message_id is None or sent_message_channel_id is None:
-                    continue
-                if lowest_percent == 100:
-                    done_guild_ids.append(guild_id)
-                update_channel = self.bot.get_channel(sent_message_channel_id)
-                if update_channel is not None:
-                    update_message = await update_channel.fetch_message(sent_message_id)
-                else:
-                    update_message = None
-                stars = int(round(lowest_percent / 10))
-                stars_string = "\\*" * stars
-                dashes = 10 - stars
-                if lowest_percent != 100:
-                    if update_message is not None:
-                        await update_message.edit(embed=self.bot.create_processing_embed(
-                            "Back-Dating Statistics",
-                            f"Progress: {stars_string}{'-' * dashes} ({lowest_percent:.2f}%)"))
-                else:
-                    if update_message is not None:
-                        await update_message.edit(embed=self.bot.create_completed_embed("Back-Dated Statistics!",
-                                                                                    "Finished back-dating statistics!"))
-            for guild_id in done_guild_ids:
-                unique_guild_ids.remove(guild_id)
-            done_guild_ids = []
-            if len(unique_guild_ids) == 0:
-                self.running = False
-                return
-            await asyncio.sleep(1)
+            await self.progress.changed.wait()
+            # Waiting a moment lets a burst of batches collapse into a single edit.
+            await asyncio.sleep(config.backfill_progress_debounce)
+            self.progress.changed.clear()
+            for guild_id in self.progress.pop_dirty_guilds():
+                try:
+                    await self.update_progress_embed(guild_id)
+                except discord.errors.HTTPException as e:
+                    print(f"Couldn't update back-fill progress for guild {guild_id}: {e}")
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # Anything else would end this task and leave every progress embed frozen until a reload.
+                    print(f"Updating back-fill progress for guild {guild_id} failed.")
+                    print(format_exc())
+
+    async def update_progress_embed(self, guild_id):
+        status_message = self.progress.status_messages.get(guild_id)
+        lowest_percent = self.progress.guild_percent(guild_id)
+        if status_message is None:
+            if lowest_percent is None:
+                self.progress.forget_guild(guild_id)
+            return
+        if lowest_percent is None:
+            text = "Finished back-dating statistics!"
+            embed = self.bot.create_completed_embed("Back-Dated Statistics!", text)
+        else:
+            stars = int(round(lowest_percent / 10))
+            stars_string = "\\*" * stars
+            dashes = 10 - stars
+            text = f"Progress: {stars_string}{'-' * dashes} ({lowest_percent:.2f}%)"
+            embed = self.bot.create_processing_embed("Back-Dating Statistics", text)
+        if self.progress.rendered.get(guild_id) != text:
+            update_message = status_message["message"]
+            if update_message is None:
+                update_channel = self.bot.get_channel(status_message["channel_id"])
+                if update_channel is None:
+                    return
+                try:
+                    update_message = await update_channel.fetch_message(status_message["message_id"])
+                except discord.errors.NotFound:
+                    self.progress.status_messages.pop(guild_id, None)
+                    return
+                status_message["message"] = update_message
+            await update_message.edit(embed=embed)
+            self.progress.rendered[guild_id] = text
+        if lowest_percent is None:
+            self.progress.forget_guild(guild_id)
+            await self.bot.mongo.discord_db.loading_stats.update_many({"guild_id": guild_id},
+                                                                      {"$unset": {"sent_message_id": ""}})
+
+    @tasks.loop(seconds=config.backfill_progress_save_interval, count=None)
+    async def save_progress(self):
+        await self.persist_progress()
+
+    async def persist_progress(self):
+        # Progress is only kept in loading_stats so that loading can pick up again after a restart, so it's
+        # written far less often than the embed is updated.
+        unsaved = self.progress.pop_unsaved()
+        if len(unsaved) == 0:
+            return
+        requests = [UpdateOne({"_id": channel_id}, {"$set": channel_progress}, upsert=True)
+                    for channel_id, channel_progress in unsaved.items()]
+        try:
+            await self.bot.mongo.discord_db.loading_stats.bulk_write(requests, ordered=False)
+        except PyMongoError as e:
+            print(f"Couldn't save back-fill progress: {e}")
+            self.progress.unsaved_channels.update(unsaved.keys())
 
     @commands.command()
     @is_staff()
     async def load_stats(self, ctx):
         sent_message = await ctx.reply(embed=self.bot.create_processing_embed("Back-dating Statistics",
                                                                               "Progress: Starting..."))
+        await self.bot.mongo.discord_db.loading_stats.update_many({"guild_id": ctx.guild.id},
+                                                                  {"$unset": {"sent_message_id": ""}})
+        loading_doc = {"_id": ctx.channel.id, "guild_id": ctx.guild.id, "sent_message_id": sent_message.id}
+        await self.bot.mongo.force_insert(self.bot.mongo.discord_db.loading_stats, loading_doc)
+        self.progress.set_status_message(ctx.guild.id, ctx.channel.id, sent_message.id)
         for channel in ctx.guild.text_channels:
             print(channel.id)
             channel_doc = await self.bot.mongo.discord_db.channels.find_one({"_id": channel.id})
             if channel_doc is not None and channel_doc.get("nostore", False):
-                if channel == ctx.channel:
-                    loading_doc = {"_id": channel.id, "guild_id": channel.guild.id, "active": False,
-                                   "sent_message_id": sent_message.id}
-                    await self.bot.mongo.force_insert(self.bot.mongo.discord_db.loading_stats, loading_doc)
                 continue
-            if channel == ctx.channel:
-                self.bot.loop.create_task(self.load_channel(channel, sent_message.id))
-            else:
-                self.bot.loop.create_task(self.load_channel(channel))
-        await asyncio.sleep(1)
-        if not self.running:
-            self.bot.loop.create_task(self.update_embeds())
+            await self.queue_channel(channel)
+        self.progress.touch(ctx.guild.id)
 
-    async def load_channel(self, channel: discord.TextChannel, sent_message_id=None):
+    async def load_channel(self, channel: discord.TextChannel):
         channel_doc = await self.bot.mongo.discord_db.channels.find_one({"_id": channel.id})
         if channel_doc is not None and channel_doc.get("nostore", False):
+            self.progress.finish(channel)
             return
-        after = datetime.datetime(2015, 1, 1)
-        most_recent_message = channel.history(limit=1)
-        most_recent_message = await most_recent_message.flatten()
-        try:
-            most_recent_message = most_recent_message[0]
-        except IndexError:
-            return
-        earliest_message = channel.history(oldest_first=True, limit=1)
-        earliest_message = await earliest_message.flatten()
-        earliest_message = earliest_message[0]
-        stored_channel = await self.bot.mongo.discord_db.loading_stats.find_one({"_id": channel.id})
-        if sent_message_id is not None and stored_channel is None:
-            loading_doc = {"_id": channel.id, "guild_id": channel.guild.id, "active": True,
-                           "sent_message_id": sent_message_id}
-            await self.bot.mongo.force_insert(self.bot.mongo.discord_db.loading_stats, loading_doc)
-        if stored_channel is not None:
-            last_message_id = stored_channel.get("message_id")
-            try:
-                last_message = await channel.fetch_message(last_message_id)
-                after = last_message
-            except discord.errors.NotFound:
-                after = stored_channel.get("message_time")
-        history_iterator = channel.history(after=after, limit=None)
-        while True:
+        # Everything up to the checkpoint is already stored, so loading carries on straight after it. The channel's
+        # newest message at the start is the target; progress is measured in snowflake time, so no messages need
+        # to be fetched to work out where loading stands.
+        checkpoint = await self.bot.mongo.get_backfill_checkpoint(channel.id)
+        last_id = 0 if checkpoint is None else checkpoint.get("last_id", 0)
+        target_id = channel.last_message_id
+        if target_id is None:
+            target_id = discord.utils.time_snowflake(datetime.datetime.utcnow())
+        history_iterator = channel.history(after=discord.Object(id=last_id), limit=None)
+        loaded_recent = False
+        while last_id < target_id:
             if history_iterator.messages.empty():
                 await history_iterator.fill_messages()
             if history_iterator.messages.empty():
                 break
             last_message = await self.add_messages_to_db(history_iterator.messages)
-            if last_message is not None:
-                if last_message == most_recent_message:
-                    await self.bot.mongo.discord_db.loading_stats.update_one({"_id": channel.id},
-                                                                             {"$set": {"active": False}})
-                    return True
-                loading_doc = {"_id": channel.id, "message_id": last_message.id,
-                               "message_time": last_message.created_at, "guild_id": channel.guild.id, "active": True,
-                               "sent_message_id": sent_message_id, "latest_time": most_recent_message.created_at,
-                               "earliest_time": earliest_message.created_at}
-                await self.bot.mongo.force_insert(self.bot.mongo.discord_db.loading_stats, loading_doc)
+            if last_message is None:
+                continue
+            last_id = max(last_id, last_message.id)
+            loaded_recent = loaded_recent or last_message.created_at > datetime.datetime.utcnow() - SCORE_WINDOW
+            await self.bot.mongo.save_backfill_checkpoint(channel, last_id, target_id, completed=last_id >= target_id)
+            self.progress.publish(channel, channel.created_at, last_message.created_at,
+                                  discord.utils.snowflake_time(target_id))
+            await self.backfill.yield_to_live()
+        # Running out of history before reaching the target (say, because the newest message was deleted) also
+        # means the channel is done.
+        await self.bot.mongo.save_backfill_checkpoint(channel, last_id, target_id, completed=True)
+        self.progress.finish(channel)
+        if loaded_recent:
+            # Back-filled messages from the past week arrive out of order, so the guild's scores are re-seeded.
+            self.scores.invalidate(channel.guild.id)
+        return True
 
     async def add_messages_to_db(self, message_queue: asyncio.Queue):
         this_batch = []
@@ -203,13 +282,27 @@ class Statistics(commands.Cog):
         await self.bot.mongo.insert_channel_messages(this_batch)
         return this_batch[-1] if len(this_batch) != 0 else None
 
+    async def snapshot_leaderboards(self):
+        """Saves every guild's leaderboard for the week that has just ended, if it hasn't been saved yet. The week
+        is scored on its own, from Monday to Monday, so it doesn't matter how long after it ends this runs."""
+        last_week_start = week_start(datetime.datetime.utcnow()) - datetime.timedelta(days=7)
+        for guild in self.bot.guilds:
+            try:
+                if await self.bot.mongo.get_leaderboard_snapshot(guild.id, last_week_start) is not None:
+                    continue
+                results = await self.scores.week_scores(guild, last_week_start)
+                await self.bot.mongo.save_leaderboard_snapshot(guild.id, last_week_start,
+                                                               results[:config.leaderboard_snapshot_size])
+            except Exception as e:
+                print(f"Couldn't snapshot the leaderboard for guild {guild.id}: {e!r}")
+
     @tasks.loop(seconds=1800, count=None)
     async def update_motw(self):
+        await self.snapshot_leaderboards()
         monkey_guild: discord.Guild = self.bot.get_guild(config.monkey_guild_id)
         motw_role = monkey_guild.get_role(config.motw_role_id)
         motw_channel: discord.TextChannel = self.bot.get_channel(config.motw_channel_id)
-        with concurrent.futures.ProcessPoolExecutor() as pool:
-            results = await self.bot.loop.run_in_executor(pool, partial(get_guild_score, config.monkey_guild_id))
+        results = await self.scores.guild_scores(monkey_guild)
         results = results[:12]
         members = []
         for motw_member in results:
@@ -241,6 +334,7 @@ class Statistics(commands.Cog):
                 await motw_channel.send(f"Welcome {member.display_name}! I hope you enjoy your stay!")
 
     async def _compile_snipe(self, message_found, channel):
+        message_found = self.bot.mongo.expand_message(message_found)
         user_id = message_found.get("user_id")
         content = message_found.get("content")
         try:
@@ -287,6 +381,7 @@ class Statistics(commands.Cog):
         if channel is None:
             channel = ctx.channel
         await self.bot.mongo.discord_db.channels.update_one({"_id": channel.id}, {"$set": {"nostore": True}})
+        self.bot.mongo.forget_channel(channel.id)
         await ctx.reply("nostore set.")
 
     @commands.command(aliases=["ghostping", "ghost"])
@@ -322,7 +417,7 @@ class Statistics(commands.Cog):
         if len(message) == 0:
             await ctx.reply(embed=self.bot.create_error_embed("I couldn't find that message!"))
             return
-        message = message[0]
+        message = self.bot.mongo.expand_message(message[0])
         sent = await ctx.reply(embed=self.bot.create_processing_embed("Processing...", "Getting message edits..."))
         edits = sorted(message.get("edits"), key=lambda x: x.get("timestamp"))
         original_message = message
@@ -418,27 +513,28 @@ class Statistics(commands.Cog):
     async def leaderpie(self, ctx):
         sent = await ctx.reply(embed=self.bot.create_processing_embed("Generating leaderboard",
                                                                       "Processing messages for leaderboard..."))
-        with concurrent.futures.ProcessPoolExecutor() as pool:
-            results = await self.bot.loop.run_in_executor(pool, partial(get_guild_score, ctx.guild.id))
-            labels = []
-            amounts = []
-            for user_id, score in results[:30]:
-                member = await self.bot.mongo.find_by_id(self.bot.mongo.discord_db.members, {"user_id": user_id,
-                                                                                             "guild_id": ctx.guild.id})
-                nickname = member.get("nick", None)
-                if nickname is None:
-                    user = await self.bot.mongo.find_by_id(self.bot.mongo.discord_db.users, user_id)
-                    nickname = user.get("name", "Unknown")
-                labels.append(nickname)
-                amounts.append(score)
-            smaller_amounts = amounts[15:]
-            labels = labels[:15]
-            amounts = amounts[:15]
-            amounts.append(sum(smaller_amounts))
-            labels.append("Other")
-            await sent.edit(embed=self.bot.create_processing_embed("Got leaderboard!", "Generating pie chart."))
-            data = await self.bot.loop.run_in_executor(pool, partial(pie_chart_from_amount_and_labels,
-                                                                     labels, amounts))
+        results = (await self.scores.guild_scores(ctx.guild))[:30]
+        member_ids = [{"user_id": user_id, "guild_id": ctx.guild.id} for user_id, _ in results]
+        member_documents = await self.bot.mongo.find_by_ids(self.bot.mongo.discord_db.members, member_ids)
+        user_documents = await self.bot.mongo.find_by_ids(self.bot.mongo.discord_db.users,
+                                                          [user_id for user_id, _ in results])
+        labels = []
+        amounts = []
+        for user_id, score in results:
+            member = member_documents.get(self.bot.mongo.hashable_id({"user_id": user_id,
+                                                                      "guild_id": ctx.guild.id}), {})
+            nickname = member.get("nick", None)
+            if nickname is None:
+                nickname = user_documents.get(user_id, {}).get("name", "Unknown")
+            labels.append(nickname)
+            amounts.append(score)
+        smaller_amounts = amounts[15:]
+        labels = labels[:15]
+        amounts = amounts[:15]
+        amounts.append(sum(smaller_amounts))
+        labels.append("Other")
+        await sent.edit(embed=self.bot.create_processing_embed("Got leaderboard!", "Generating pie chart."))
+        data = await self.bot.render_pool.run(pie_chart_from_amount_and_labels, labels, amounts)
         file = BytesIO(data)
         file.seek(0)
         discord_file = discord.File(fp=file, filename="image.png")
@@ -449,8 +545,7 @@ class Statistics(commands.Cog):
     async def score(self, ctx, member: Optional[discord.Member]):
         if member is None:
             member = ctx.author
-        with concurrent.futures.ProcessPoolExecutor() as pool:
-            score = await self.bot.loop.run_in_executor(pool, partial(get_user_score, member.id, member.guild.id))
+        score = await self.scores.user_score(member)
         embed = self.bot.create_completed_embed(f"Score for {member.nick or member.name} - past 7 days",
                                                 str(score))
         if ctx.guild.id == config.monkey_guild_id:
@@ -470,7 +565,7 @@ class Statistics(commands.Cog):
 
         amount = await self.bot.mongo.discord_db.messages.count_documents({"$text": {"$search": phrase},
                                                                            "guild_id": ctx.guild.id,
-                                                                           "deleted": False})
+                                                                           "deleted": NOT_DELETED})
         embed = self.bot.create_completed_embed(
             f"Number of times \"{phrase}\" has been said:", f"**{amount}** times!")
         embed.set_footer(text="If you entered a phrase, remember to surround it in **straight** quotes ("
@@ -490,7 +585,7 @@ class Statistics(commands.Cog):
         amount = await self.bot.mongo.discord_db.messages.count_documents({"$text": {"$search": phrase},
                                                                            "guild_id": ctx.guild.id,
                                                                            "user_id": member.id,
-                                                                           "deleted": False})
+                                                                           "deleted": NOT_DELETED})
         embed = self.bot.create_completed_embed(
             f"Number of times {member.display_name} said: \"{phrase}\":", f"**{amount}** times!")
         embed.set_footer(text="If you entered a phrase, remember to surround it in **straight** quotes (\"\")!")
@@ -516,11 +611,43 @@ class Statistics(commands.Cog):
     @commands.command(description="Count how many messages have been sent in this guild!")
     async def messages(self, ctx):
         sent = await ctx.reply(embed=self.bot.create_processing_embed("Counting...", "Counting all messages sent..."))
-        amount = await self.bot.mongo.discord_db.messages.count_documents({"guild_id": ctx.guild.id, "deleted": False})
+        amount = await self.bot.mongo.discord_db.messages.count_documents({"guild_id": ctx.guild.id,
+                                                                           "deleted": NOT_DELETED})
         await sent.edit(embed=self.bot.create_completed_embed(
             title="Total Messages sent in this guild!", text=f"**{amount:,}** messages!"
         ))
 
+    async def message_graph(self, guild_id, match, group, use_rollups=True):
+        """Counts the messages matching match from the cheapest source available and returns the function that plots
+        them, its data and a watermark of that data: the guild's rollups if they've been built, then per-period counts
+        from the server, and only if neither works every message's timestamp."""
+        if use_rollups and await self.bot.mongo.rollups_ready(guild_id):
+            counts = await self.bot.mongo.daily_message_counts(match)
+            return file_from_counts, counts, tuple(sorted(counts))
+        if group in DATE_TRUNC_UNITS:
+            try:
+                counts = await self.bot.mongo.bucketed_message_counts(match, group)
+                return file_from_counts, counts, tuple(sorted(counts))
+            except OperationFailure as e:
+                print(f"Server-side bucketing failed, fetching every timestamp instead: {e}")
+        timestamps = await self.bot.mongo.load_timestamps(match)
+        return file_from_shared_timestamps, timestamps, (timestamps.length, timestamps.latest())
+
+    async def render_message_graph(self, kind, ids, match, group, use_rollups=True):
+        """The PNG of message_graph's plot, from the graph cache if the counts haven't changed since it was last
+        rendered."""
+        plot, plot_data, watermark = await self.message_graph(ids[0], match, group, use_rollups)
+        try:
+            key = graph_key(kind, ids, group, watermark)
+            data = await self.graphs.get(key)
+            if data is None:
+                data = await self.bot.render_pool.run(plot, plot_data, group)
+                await self.graphs.put(key, data)
+            return data
+        finally:
+            if isinstance(plot_data, SharedTimestamps):
+                plot_data.close()
+
     # noinspection DuplicatedCode
     @commands.command(description="Plots a graph of word usage over time.", aliases=["wordstats, wordusage",
                                                                                      "word_stats", "phrase_usage",
@@ -531,18 +658,10 @@ class Statistics(commands.Cog):
             if len(phrase) > 180:
                 await ctx.reply(embed=self.bot.create_error_embed("That phrase was too long!"))
                 return
-            pipeline = [
-                {
-                    "$match": {"guild_id": ctx.guild.id, "deleted": False, "$text": {"$search": phrase}}
-                },
-                {
-                    "$project": {"_id": "$created_at"}
-                }
-            ]
-            aggregation = self.bot.mongo.discord_db.messages.aggregate(pipeline=pipeline)
-            times = [x.get("_id") for x in await aggregation.to_list(length=None)]
-            with concurrent.futures.ProcessPoolExecutor() as pool:
-                data = await self.bot.loop.run_in_executor(pool, partial(file_from_timestamps, times, group))
+            # Rollups don't know what a message said, so this always counts the messages themselves.
+            data = await self.render_message_graph("word_usage", (ctx.guild.id, phrase),
+                                                   {"guild_id": ctx.guild.id, "deleted": NOT_DELETED,
+                                                    "$text": {"$search": phrase}}, group, use_rollups=False)
             file = BytesIO(data)
             file.seek(0)
             discord_file = discord.File(fp=file, filename="image.png")
@@ -550,33 +669,50 @@ class Statistics(commands.Cog):
             embed.set_image(url="attachment://image.png")
             await ctx.reply(embed=embed, file=discord_file)
 
-    @commands.command()
-    async def leaderboard(self, ctx):
+    @commands.command(usage="[--week weeks_ago]")
+    async def leaderboard(self, ctx, option: Optional[str] = None, weeks_ago: Optional[int] = 1):
+        if option == "--week":
+            if weeks_ago < 1:
+                await ctx.reply(embed=self.bot.create_error_embed("Use --week 1 for last week, --week 2 for the week "
+                                                                  "before, and so on."))
+                return
+            snapshot_week = week_start(datetime.datetime.utcnow()) - datetime.timedelta(days=7 * weeks_ago)
+            snapshot = await self.bot.mongo.get_leaderboard_snapshot(ctx.guild.id, snapshot_week)
+            if snapshot is None:
+                await ctx.reply(embed=self.bot.create_error_embed("There's no saved leaderboard for that week."))
+                return
+            results = [(user_id, score) for user_id, score in snapshot.get("scores", [])][:12]
+            embed = await self.leaderboard_embed(ctx.guild, results,
+                                                 f"Activity Leaderboard - Week of {snapshot_week:%d %B %Y}")
+            await ctx.reply(embed=embed)
+            return
         sent = await ctx.reply(embed=self.bot.create_processing_embed("Generating leaderboard",
                                                                       "Processing messages for leaderboard..."))
-        with concurrent.futures.ProcessPoolExecutor() as pool:
-            results = await self.bot.loop.run_in_executor(pool, partial(get_guild_score, ctx.guild.id))
+        results = await self.scores.guild_scores(ctx.guild)
         results = results[:12]
-        embed = discord.Embed(title="Activity Leaderboard - Past 7 Days", colour=discord.Colour.green())
+        embed = await self.leaderboard_embed(ctx.guild, results, "Activity Leaderboard - Past 7 Days")
+        await sent.edit(embed=embed)
+
+    async def leaderboard_embed(self, guild, results, title):
+        embed = discord.Embed(title=title, colour=discord.Colour.green())
         embed.description = "```"
-        if ctx.guild.id == config.monkey_guild_id:
+        if guild.id == config.monkey_guild_id:
             embed.set_footer(text="More information about this in #role-assign (monkeys of the week!)")
         else:
             embed.set_footer(text="Most active users this week! Score is based off of your active time this week.")
+        names = await self.names.resolve(guild, [user_id for user_id, _ in results])
+        names = [unidecode.unidecode(names[user_id]) for user_id, _ in results]
         lengthening = []
-        for index, user in enumerate(results):
-            name = await self.name_from_id(user[0], ctx.guild)
-            name = unidecode.unidecode(name)
+        for index, name in enumerate(names):
             name_length = len(name)
             lengthening.append(name_length + len(str(index + 1)))
-        max_length = max(lengthening)
+        max_length = max(lengthening, default=0)
         for i in range(len(results)):
-            name = await self.name_from_id(results[i][0], ctx.guild)
-            name = unidecode.unidecode(name)
+            name = names[i]
             text = f"{i + 1}. {name}" + " " * (max_length - lengthening[i]) + f" | Score: {results[i][1]}\n"
             embed.description += text
         embed.description += "```"
-        await sent.edit(embed=embed)
+        return embed
 
     @commands.command()
     async def first_message(self, ctx, member: Optional[discord.Member]):
@@ -613,18 +749,8 @@ class Statistics(commands.Cog):
         english_group = {'d': "Day", 'w': "Week", 'm': "Month", 'y': "Year"}
         sent = await ctx.reply(embed=self.bot.create_processing_embed("Processing messages", "Compiling graph for all "
                                                                                              "your messages..."))
-        pipeline = [
-            {
-                "$match": {"guild_id": ctx.guild.id, "user_id": member.id}
-            },
-            {
-                "$project": {"_id": "$created_at"}
-            }
-        ]
-        aggregation = self.bot.mongo.discord_db.messages.aggregate(pipeline)
-        times = [x.get("_id") for x in await aggregation.to_list(length=None)]
-        with concurrent.futures.ProcessPoolExecutor() as pool:
-            data = await self.bot.loop.run_in_executor(pool, partial(file_from_timestamps, times, group))
+        data = await self.render_message_graph("stats", (ctx.guild.id, member.id),
+                                               {"guild_id": ctx.guild.id, "user_id": member.id}, group)
         file = BytesIO(data)
         file.seek(0)
         discord_file = discord.File(fp=file, filename="image.png")
@@ -643,6 +769,7 @@ class Statistics(commands.Cog):
         channel = await self.bot.mongo.find_by_id(self.bot.mongo.discord_db.channels, channel.id)
         await self.bot.mongo.discord_db.channels.update_one({"_id": channel["_id"]},
                                                             {'$set': {"excluded": not channel.get("excluded", False)}})
+        self.scores.invalidate(ctx.guild.id)
         await sent.edit(embed=self.bot.create_completed_embed("Changed excluded status!",
                                                               f"Channel has been "
                                                               f"{'un' if channel.get('excluded', False) else ''}"
@@ -657,20 +784,8 @@ class Statistics(commands.Cog):
         english_group = {'d': "Day", 'w': "Week", 'm': "Month", 'y': "Year"}
         sent = await ctx.reply(embed=self.bot.create_processing_embed("Processing messages",
                                                                       "Fetching all server messages..."))
-        pipeline = [
-            {
-                "$match": {"guild_id": ctx.guild.id}
-            },
-            {
-                "$project": {"_id": "$created_at"}
-            }
-        ]
-        aggregation = self.bot.mongo.discord_db.messages.aggregate(pipeline)
-        message_list = [x.get("_id") for x in await aggregation.to_list(length=None)]
-        await sent.edit(embed=self.bot.create_processing_embed("Processing messages",
-                                                               "Creating graph of all server messages..."))
-        with concurrent.futures.ProcessPoolExecutor() as pool:
-            raw_data = await self.bot.loop.run_in_executor(pool, partial(file_from_timestamps, message_list, group))
+        raw_data = await self.render_message_graph("server_stats", (ctx.guild.id,), {"guild_id": ctx.guild.id},
+                                                   group)
         file = BytesIO(raw_data)
         file.seek(0)
         discord_file = discord.File(fp=file, filename="image.png")
@@ -745,18 +860,6 @@ class Statistics(commands.Cog):
                               colour=discord.Colour.green())
         await ctx.reply(embed=embed)
 
-    async def name_from_id(self, user_id, guild):
-        member = guild.get_member(user_id)
-        if member is None:
-            member = await self.bot.fetch_user(user_id)
-            if member is None:
-                name = "Unknown Member"
-            else:
-                name = member.name
-        else:
-            name = (member.nick or member.name)
-        return name
-
 
 def setup(bot: UtilsBot):
     cog = Statistics(bot)
@@ -1,8 +1,6 @@
 import asyncio
 import datetime
 from collections import defaultdict
-from concurrent.futures import ProcessPoolExecutor
-from functools import partial
 from io import BytesIO
 
 import discord
@@ -66,9 +64,7 @@ class Skyblock(commands.Cog):
                                                 calculation))
                     current_datetime = next_datetime
                 flip_data = await asyncio.gather(*tasks)
-                with ProcessPoolExecutor() as pool:
-                    data = await self.bot.loop.run_in_executor(pool, partial(tfm_graph, flip_data,
-                                                                             y_label))
+                data = await self.bot.render_pool.run(tfm_graph, flip_data, y_label)
                 self.cached_graphs[name] = data
                 self.last_cached_time[name] = datetime.datetime.utcnow()
         file = BytesIO(data)
@@ -284,14 +280,9 @@ class Skyblock(commands.Cog):
             if len(maximum_prices) == 0:
                 await ctx.reply(embed=self.bot.create_error_embed("No auctions could be found."))
                 return
-            with ProcessPoolExecutor() as pool:
-                data = await self.bot.loop.run_in_executor(pool, partial(plot_multiple,
-                                                                         title=f"Prices for {query} books",
-                                                                         x_label="Date",
-                                                                         y_label="Price in coins",
-                                                                         Minimum=minimum_prices,
-                                                                         Average=average_prices,
-                                                                         Maximum=maximum_prices))
+            data = await self.bot.render_pool.run(plot_multiple, title=f"Prices for {query} books", x_label="Date",
+                                                  y_label="Price in coins", Minimum=minimum_prices,
+                                                  Average=average_prices, Maximum=maximum_prices)
             file = BytesIO(data)
             file.seek(0)
             discord_file = discord.File(fp=file, filename="image.png")
@@ -311,13 +302,9 @@ class Skyblock(commands.Cog):
             if len(maximum_prices) == 0:
                 await ctx.reply(embed=self.bot.create_error_embed("No auctions could be found."))
                 return
-            with ProcessPoolExecutor() as pool:
-                data = await self.bot.loop.run_in_executor(pool, partial(plot_multiple,
-                                                                         title=f"Average prices for {query} books",
-                                                                         x_label="Date",
-                                                                         y_label="Price in coins",
-                                                                         Minimum=minimum_prices,
-                                                                         Average=average_prices))
+            data = await self.bot.render_pool.run(plot_multiple, title=f"Average prices for {query} books",
+                                                  x_label="Date", y_label="Price in coins", Minimum=minimum_prices,
+                                                  Average=average_prices)
             file = BytesIO(data)
             file.seek(0)
             discord_file = discord.File(fp=file, filename="image.png")
@@ -334,12 +321,8 @@ class Skyblock(commands.Cog):
             if len(maximum_prices) == 0:
                 await ctx.reply(embed=self.bot.create_error_embed("No auctions could be found."))
                 return
-            with ProcessPoolExecutor() as pool:
-                data = await self.bot.loop.run_in_executor(pool, partial(plot_multiple,
-                                                                         title=f"Minimum prices for {query} books",
-                                                                         x_label="Date",
-                                                                         y_label="Price in coins",
-                                                                         Minimum=minimum_prices))
+            data = await self.bot.render_pool.run(plot_multiple, title=f"Minimum prices for {query} books",
+                                                  x_label="Date", y_label="Price in coins", Minimum=minimum_prices)
             file = BytesIO(data)
             file.seek(0)
             discord_file = discord.File(fp=file, filename="image.png")
@@ -426,14 +409,9 @@ class Skyblock(commands.Cog):
             if len(maximum_prices) == 0:
                 await ctx.reply(embed=self.bot.create_error_embed("No auctions could be found."))
                 return
-            with ProcessPoolExecutor() as pool:
-                data = await self.bot.loop.run_in_executor(pool, partial(plot_multiple,
-                                                                         title=f"Historical prices for {query}",
-                                                                         x_label="Date",
-                                                                         y_label="Price in coins",
-                                                                         Minimum=minimum_prices,
-                                                                         Average=average_prices,
-                                                                         Maximum=maximum_prices))
+            data = await self.bot.render_pool.run(plot_multiple, title=f"Historical prices for {query}", x_label="Date",
+                                                  y_label="Price in coins", Minimum=minimum_prices,
+                                                  Average=average_prices, Maximum=maximum_prices)
             file = BytesIO(data)
             file.seek(0)
             discord_file = discord.File(fp=file, filename="image.png")
@@ -450,13 +428,9 @@ class Skyblock(commands.Cog):
             if len(maximum_prices) == 0:
                 await ctx.reply(embed=self.bot.create_error_embed("No auctions could be found."))
                 return
-            with ProcessPoolExecutor() as pool:
-                data = await self.bot.loop.run_in_executor(pool, partial(plot_multiple,
-                                                                         title=f"Average prices for {query}",
-                                                                         x_label="Date",
-                                                                         y_label="Price in coins",
-                                                                         Minimum=minimum_prices,
-                                                                         Average=average_prices))
+            data = await self.bot.render_pool.run(plot_multiple, title=f"Average prices for {query}", x_label="Date",
+                                                  y_label="Price in coins", Minimum=minimum_prices,
+                                                  Average=average_prices)
             file = BytesIO(data)
             file.seek(0)
             discord_file = discord.File(fp=file, filename="image.png")
@@ -522,12 +496,8 @@ class Skyblock(commands.Cog):
             if len(maximum_prices) == 0:
                 await ctx.reply(embed=self.bot.create_error_embed("No auctions could be found."))
                 return
-            with ProcessPoolExecutor() as pool:
-                data = await self.bot.loop.run_in_executor(pool, partial(plot_multiple,
-                                                                         title=f"Minimum prices for {query}",
-                                                                         x_label="Date",
-                                                                         y_label="Price in coins",
-                                                                         Minimum=minimum_prices))
+            data = await self.bot.render_pool.run(plot_multiple, title=f"Minimum prices for {query}", x_label="Date",
+                                                  y_label="Price in coins", Minimum=minimum_prices)
             file = BytesIO(data)
             file.seek(0)
             discord_file = discord.File(fp=file, filename="image.png")
@@ -0,0 +1,160 @@
+import asyncio
+import collections
+import heapq
+import itertools
+from traceback import format_exc
+
+from src.helpers.metrics_helper import metrics
+from src.storage import config
+
+backfill_jobs = metrics.gauge("utils_backfill_jobs", "Back-fill jobs, by state.", ("state",))
+
+
+class BackfillScheduler:
+    """Runs back-fill jobs in the background with at most config.backfill_concurrency of them at once.
+
+    Guilds take turns so one huge guild can't hold up everyone else, and within a guild the job with the most left
+    to do starts first so the longest channel isn't left running alone at the end. Jobs should await
+    yield_to_live() between batches, which waits for as long as live_busy() says live message ingestion is busy."""
+    def __init__(self, live_busy=None):
+        self.live_busy = live_busy
+        self.guild_queues = {}
+        self.guild_order = collections.deque()
+        self.queued_keys = {}
+        self.running_keys = {}
+        self.jobs_available = asyncio.Event()
+        self.tiebreaker = itertools.count()
+        self.workers = [asyncio.get_event_loop().create_task(self.worker())
+                        for _ in range(config.backfill_concurrency)]
+        backfill_jobs.set_function(lambda: len(self.queued_keys), state="queued")
+        backfill_jobs.set_function(lambda: len(self.running_keys), state="running")
+
+    def submit(self, guild_id, key, estimated_remaining, job):
+        """Queues job (a function returning a coroutine) unless a job with the same key is already queued or
+        running. Returns whether it was queued."""
+        if key in self.queued_keys or key in self.running_keys:
+            return False
+        if guild_id not in self.guild_queues:
+            self.guild_queues[guild_id] = []
+            self.guild_order.append(guild_id)
+        heapq.heappush(self.guild_queues[guild_id], (-estimated_remaining, next(self.tiebreaker), key, job))
+        self.queued_keys[key] = guild_id
+        self.jobs_available.set()
+        return True
+
+    def _pop_job(self):
+        if len(self.guild_order) == 0:
+            return None
+        guild_id = self.guild_order.popleft()
+        guild_queue = self.guild_queues[guild_id]
+        _, _, key, job = heapq.heappop(guild_queue)
+        if len(guild_queue) > 0:
+            self.guild_order.append(guild_id)
+        else:
+            del self.guild_queues[guild_id]
+        del self.queued_keys[key]
+        return guild_id, key, job
+
+    async def next_job(self):
+        while True:
+            next_job = self._pop_job()
+            if next_job is not None:
+                return next_job
+            self.jobs_available.clear()
+            await self.jobs_available.wait()
+
+    async def yield_to_live(self):
+        if self.live_busy is None:
+            return
+        while self.live_busy():
+            await asyncio.sleep(config.backfill_yield_interval)
+
+    async def worker(self):
+        while True:
+            guild_id, key, job = await self.next_job()
+            self.running_keys[key] = guild_id
+            try:
+                await self.yield_to_live()
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                print(f"Back-fill job {key} failed.")
+                print(format_exc())
+            finally:
+                del self.running_keys[key]
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+
+
+class BackfillProgress:
+    """In-process record of how far each channel's back-fill has got.
+
+    load_channel publishes into it as batches are stored, which marks the channel's guild (for the progress embed)
+    and the channel (for loading_stats) as changed and sets the changed event."""
+    def __init__(self):
+        self.channels = {}
+        self.status_messages = {}
+        self.rendered = {}
+        self.dirty_guilds = set()
+        self.unsaved_channels = set()
+        self.changed = asyncio.Event()
+
+    def set_status_message(self, guild_id, channel_id, message_id):
+        self.status_messages[guild_id] = {"channel_id": channel_id, "message_id": message_id, "message": None}
+        self.rendered.pop(guild_id, None)
+
+    def publish(self, channel, earliest_time, message_time, latest_time, active=True):
+        self.channels[channel.id] = {"guild_id": channel.guild.id, "earliest_time": earliest_time,
+                                     "message_time": message_time, "latest_time": latest_time, "active": active}
+        self.dirty_guilds.add(channel.guild.id)
+        self.unsaved_channels.add(channel.id)
+        self.changed.set()
+
+    def finish(self, channel):
+        channel_progress = self.channels.get(channel.id)
+        if channel_progress is None:
+            return
+        channel_progress["message_time"] = channel_progress["latest_time"]
+        channel_progress["active"] = False
+        self.dirty_guilds.add(channel.guild.id)
+        self.unsaved_channels.add(channel.id)
+        self.changed.set()
+
+    def touch(self, guild_id):
+        self.dirty_guilds.add(guild_id)
+        self.changed.set()
+
+    def guild_percent(self, guild_id):
+        """The progress of the guild's least complete active channel, or None if none are active."""
+        lowest_percent = None
+        for channel_progress in self.channels.values():
+            if channel_progress["guild_id"] != guild_id or not channel_progress["active"]:
+                continue
+            total = (channel_progress["latest_time"] - channel_progress["earliest_time"]).total_seconds()
+            done = (channel_progress["message_time"] - channel_progress["earliest_time"]).total_seconds()
+            percent = 100 if total <= 0 else min(max(done / total * 100, 0), 100)
+            if lowest_percent is None or percent < lowest_percent:
+                lowest_percent = percent
+        return lowest_percent
+
+    def forget_guild(self, guild_id):
+        self.status_messages.pop(guild_id, None)
+        self.rendered.pop(guild_id, None)
+        for channel_id in [channel_id for channel_id, channel_progress in self.channels.items()
+                           if channel_progress["guild_id"] == guild_id and not channel_progress["active"]
+                           and channel_id not in self.unsaved_channels]:
+            del self.channels[channel_id]
+
+    def pop_dirty_guilds(self):
+        dirty_guilds = self.dirty_guilds
+        self.dirty_guilds = set()
+        return dirty_guilds
+
+    def pop_unsaved(self):
+        unsaved = {channel_id: self.channels[channel_id] for channel_id in self.unsaved_channels
+                   if channel_id in self.channels}
+        self.unsaved_channels = set()
+        return unsaved
@@ -0,0 +1,201 @@
+import asyncio
+import math
+import time
+from traceback import format_exc
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from src.helpers.metrics_helper import metrics
+from src.helpers.spool_helper import MessageSpool
+from src.storage import config
+
+flush_latency = metrics.histogram("utils_buffer_flush_seconds", "Time taken to flush a write buffer.", ("buffer",))
+
+
+class MessageBuffer:
+    """Write-behind buffer for message documents.
+
+    Documents are held in memory and written as one unordered bulk upsert once either
+    config.message_flush_size documents are waiting or config.message_flush_interval_ms has passed.
+    If Mongo is down or slower than config.mongo_slow_timeout, documents go to the local spool instead."""
+    def __init__(self, mongo, spool: MessageSpool):
+        self.mongo = mongo
+        self.spool = spool
+        self.pending = {}
+        self.flush_lock = asyncio.Lock()
+        self.flush_timer = None
+        self.flush_scheduled = False
+        self.last_flush_latency = 0.0
+        self.last_flush_size = 0
+        self.total_flushed = 0
+        # Arrivals, each decaying away over config.message_rate_window seconds.
+        self.recent_messages = 0.0
+        self.recent_messages_at = time.monotonic()
+
+    @property
+    def queue_depth(self):
+        return len(self.pending)
+
+    def _decayed_recent_messages(self):
+        elapsed = time.monotonic() - self.recent_messages_at
+        return self.recent_messages * math.exp(-elapsed / config.message_rate_window)
+
+    @property
+    def message_rate(self):
+        """Messages added per second, averaged over roughly the last config.message_rate_window seconds."""
+        return self._decayed_recent_messages() / config.message_rate_window
+
+    def add(self, message_document):
+        self.recent_messages = self._decayed_recent_messages() + 1
+        self.recent_messages_at = time.monotonic()
+        self.pending[message_document["_id"]] = message_document
+        if len(self.pending) >= config.message_flush_size:
+            # One waiting flush takes everything pending when it gets the lock, so there's no need for another.
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                asyncio.get_event_loop().create_task(self.flush())
+        elif self.flush_timer is None:
+            self.flush_timer = asyncio.get_event_loop().create_task(self.flush_later())
+
+    async def edit(self, edit):
+        """Stores an edit (from MongoDB.edit_from_payload) once the message it edits has been written. Holding the
+        flush lock means the edit can't reach Mongo before an in-flight insert of the same message."""
+        async with self.flush_lock:
+            if edit["_id"] in self.pending:
+                await self._flush()
+            if self.spool.active:
+                await self.spool.append("edits", [edit])
+                return
+            try:
+                await asyncio.wait_for(self.mongo.apply_edit(edit), config.mongo_slow_timeout)
+            except (asyncio.TimeoutError, PyMongoError):
+                print(f"Edit of message {edit['_id']} failed, spooling it.")
+                print(format_exc())
+                await self.spool.append("edits", [edit])
+
+    def mark_deleted(self, message_id):
+        """Flags a message that hasn't been written yet as deleted. Returns whether the message was buffered."""
+        message_document = self.pending.get(message_id)
+        if message_document is None:
+            return False
+        message_document["deleted"] = True
+        return True
+
+    async def flush_later(self):
+        await asyncio.sleep(config.message_flush_interval_ms / 1000)
+        self.flush_timer = None
+        await self.flush()
+
+    async def flush(self):
+        async with self.flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        # Only call with flush_lock held.
+        self.flush_scheduled = False
+        if len(self.pending) == 0:
+            return
+        message_documents = list(self.pending.values())
+        self.pending = {}
+        requests = [UpdateOne({"_id": document["_id"]}, {"$set": document}, upsert=True)
+                    for document in message_documents]
+        start = time.perf_counter()
+        if self.spool.active:
+            await self.spool.append("messages", message_documents)
+        else:
+            inserted_documents = []
+            try:
+                result = await asyncio.wait_for(self.mongo.discord_db.messages.bulk_write(requests, ordered=False),
+                                                config.mongo_slow_timeout)
+                inserted_documents = [message_documents[index] for index in result.upserted_ids]
+            except BulkWriteError as e:
+                print(f"Message flush had {len(e.details.get('writeErrors', []))} write errors.")
+                inserted_documents = [message_documents[upserted["index"]]
+                                      for upserted in e.details.get("upserted", [])]
+            except (asyncio.TimeoutError, PyMongoError):
+                print(f"Message flush of {len(message_documents)} documents failed, spooling them.")
+                print(format_exc())
+                await self.spool.append("messages", message_documents)
+            try:
+                await self.mongo.increment_rollups(inserted_documents)
+            except PyMongoError as e:
+                print(f"Couldn't update message rollups: {e}")
+        self.last_flush_latency = time.perf_counter() - start
+        flush_latency.observe(self.last_flush_latency, buffer="messages")
+        self.last_flush_size = len(message_documents)
+        self.total_flushed += len(message_documents)
+
+    async def drain(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        await self.flush()
+
+
+class DeleteBuffer:
+    """Coalesces deleted-message flags into a single update_many per flush.
+
+    The first delete starts the flush timer and later ones don't push it back, so a deletion is written at most
+    config.delete_flush_interval_ms after it arrives (plus the time the write itself takes)."""
+    def __init__(self, mongo, message_buffer: MessageBuffer):
+        self.mongo = mongo
+        self.message_buffer = message_buffer
+        self.pending = set()
+        self.flush_timer = None
+        self.flush_scheduled = False
+        self.last_flush_latency = 0.0
+        self.last_flush_size = 0
+
+    @property
+    def queue_depth(self):
+        return len(self.pending)
+
+    def add(self, message_ids):
+        for message_id in message_ids:
+            # Messages that haven't been written yet are just flagged in the message buffer.
+            if not self.message_buffer.mark_deleted(message_id):
+                self.pending.add(message_id)
+        if len(self.pending) >= config.delete_flush_size:
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                asyncio.get_event_loop().create_task(self.flush())
+        elif len(self.pending) > 0 and self.flush_timer is None:
+            self.flush_timer = asyncio.get_event_loop().create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(config.delete_flush_interval_ms / 1000)
+        self.flush_timer = None
+        await self.flush()
+
+    async def flush(self):
+        # Holding the message buffer's lock means a delete can't be written before an in-flight insert of the
+        # same message.
+        async with self.message_buffer.flush_lock:
+            self.flush_scheduled = False
+            if len(self.pending) == 0:
+                return
+            message_ids = list(self.pending)
+            self.pending = set()
+            start = time.perf_counter()
+            spool = self.message_buffer.spool
+            if spool.active:
+                await spool.append("deleted", message_ids)
+            else:
+                try:
+                    await asyncio.wait_for(self.mongo.discord_db.messages.update_many({"_id": {"$in": message_ids}},
+                                                                                      {"$set": {"deleted": True}}),
+                                           config.mongo_slow_timeout)
+                except (asyncio.TimeoutError, PyMongoError):
+                    print(f"Delete flush of {len(message_ids)} messages failed, spooling them.")
+                    print(format_exc())
+                    await spool.append("deleted", message_ids)
+            self.last_flush_latency = time.perf_counter() - start
+            flush_latency.observe(self.last_flush_latency, buffer="deleted")
+            self.last_flush_size = len(message_ids)
+
+    async def drain(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        await self.flush()
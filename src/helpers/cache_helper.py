@@ -0,0 +1,80 @@
+import time
+from collections import OrderedDict
+
+from src.helpers.metrics_helper import cache_requests
+
+
+class LRUCache:
+    """Least-recently-used cache with an optional time-to-live on every entry. Named caches report their hits and
+    misses to /metrics."""
+    _missing = object()
+
+    def __init__(self, max_size=1024, ttl=None, name=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.name = name
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key, self._missing)
+        if entry is self._missing:
+            self._record(False)
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            # Left in place until it's replaced or evicted, so peek(allow_expired=True) can still read it.
+            self._record(False)
+            return default
+        self.entries.move_to_end(key)
+        self._record(True)
+        return value
+
+    def peek(self, key, default=None, allow_expired=False):
+        """Like get, but doesn't count as a use: the entry's place in the LRU order and the hit/miss counts are
+        left alone. With allow_expired, returns the last value stored even once it has expired."""
+        entry = self.entries.get(key, self._missing)
+        if entry is self._missing:
+            return default
+        value, expires_at = entry
+        if not allow_expired and expires_at is not None and expires_at < time.monotonic():
+            return default
+        return value
+
+    def _record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.name is not None:
+            cache_requests.inc(cache=self.name, result="hit" if hit else "miss")
+
+    def __contains__(self, key):
+        return self.get(key, self._missing) is not self._missing
+
+    def __setitem__(self, key, value):
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def clear(self):
+        self.entries.clear()
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / total
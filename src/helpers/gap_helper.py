@@ -0,0 +1,125 @@
+import math
+
+import numpy as np
+
+SEARCH_CHUNK_SIZE = 4096
+
+
+def _steps(user_ids, times, steps):
+    """Fills steps with the time from each message to the next, and returns the index where each user's messages
+    start. The step into a user's first message is left as 0, so a step below 0 means messages out of time order."""
+    user_starts = np.flatnonzero(user_ids[1:] != user_ids[:-1])
+    user_starts += 1
+    np.subtract(times[1:], times[:-1], out=steps)
+    steps[user_starts - 1] = 0
+    return np.concatenate(([0], user_starts))
+
+
+def _greedy_gap(user_ids, timestamps, gap_seconds):
+    """The work behind greedy_gap_points and greedy_gap_scores. Returns the order the messages were put in (None if
+    they were already sorted by user and then time), the user ids in that order, the index where each user's
+    messages start, and whether each message scores."""
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    times = np.asarray(timestamps)
+    if times.dtype.kind != "M":
+        times = times.astype("datetime64[us]")
+    # Work in whatever unit the timestamps are in, rounding the gap up: a difference below it is below the real gap.
+    unit = np.datetime_data(times.dtype)[0]
+    gap = math.ceil(gap_seconds * (np.timedelta64(1, "s") / np.timedelta64(1, unit)))
+    times = times.view(np.int64)
+    count = len(user_ids)
+    # The steps between messages and, once they're done with, the next message in each chain share one buffer:
+    # allocating a new array that size costs more than most of the arithmetic.
+    buffer = np.empty(count + 1, dtype=np.int64)
+    steps = buffer[1:count]
+    user_starts = _steps(user_ids, times, steps)
+    # Put each user's messages together, in time order (stably, so ties keep the order given).
+    order = None
+    if np.any(user_ids[user_starts[1:]] <= user_ids[user_starts[:-1]]) or steps.min(initial=0) < 0:
+        if np.any(times[1:] < times[:-1]):
+            order = np.argsort(times, kind="stable")
+            order = order[np.argsort(user_ids[order], kind="stable")]
+        else:
+            order = np.argsort(user_ids, kind="stable")
+        user_ids = user_ids[order]
+        times = times[order]
+        user_starts = _steps(user_ids, times, steps)
+    # A message scores for certain if it's the user's first, or at least gap after their previous message: the last
+    # scoring message can't be any later than that.
+    scoring = np.empty(count + 1, dtype=bool)
+    np.greater_equal(steps, gap, out=scoring[1:count])
+    scoring[user_starts] = True
+    scoring[count] = False
+    # The rest are in doubt. One scores if the message before it hands the score on, where a message hands it on to
+    # the user's first message at least gap after it. A message can only hand it on to one in doubt if the message
+    # straight after it is in doubt, so only those chains need following; the rest end at a certain message anyway.
+    sources = np.flatnonzero(~scoring[1:count])
+    if len(sources) > 0:
+        # One sortable key per message: the user in the high bits, time in the low bits. A search that runs past
+        # the user's last message lands on the next user's first, which is certain.
+        start = times.min()
+        shift = (int(times.max()) - int(start) + gap).bit_length()
+        if shift + len(user_starts).bit_length() > 62:
+            raise ValueError("Too many users over too long a time to score at once.")
+        keys = np.repeat(np.arange(len(user_starts), dtype=np.int64) << shift, np.diff(user_starts, append=count))
+        keys += times
+        keys -= start
+        needles = keys[sources]
+        needles += gap
+        # Search a slice of the keys for each run of sources: a target is never before its source, and a binary
+        # search over a few thousand keys is a lot quicker than one over them all.
+        targets = np.empty(len(sources), dtype=np.int64)
+        for first in range(0, len(sources), SEARCH_CHUNK_SIZE):
+            last = min(first + SEARCH_CHUNK_SIZE, len(sources))
+            low = sources[first]
+            high = np.searchsorted(keys, needles[last - 1], side="left") + 1
+            targets[first:last] = np.searchsorted(keys[low:high], needles[first:last], side="left")
+            targets[first:last] += low
+        # Only chains through messages in doubt need following, and a message in doubt that nothing hands on to can't
+        # score, so no chain goes through it: leave out both. (Here and below, indexing with flatnonzero's indices is
+        # several times faster than indexing with the boolean mask itself.)
+        scoring[count] = True
+        reached = scoring.copy()
+        reached[targets] = True
+        followed = np.flatnonzero(reached[sources] & ~scoring[targets])
+        scoring[count] = False
+        sources = sources[followed]
+        next_index = buffer
+        next_index.fill(count)
+        next_index[sources] = targets[followed]
+        # Pointer jumping: in round i, next_index jumps 2 ** i messages ahead, so applying it to everything reached
+        # so far doubles how far down the chains has been reached. A message whose jump runs off the end is done.
+        while len(sources) > 0:
+            jumps = next_index[sources]
+            scoring[jumps[np.flatnonzero(scoring[sources])]] = True
+            jumps = next_index[jumps]
+            next_index[sources] = jumps
+            sources = sources[np.flatnonzero(jumps != count)]
+        scoring[count] = False
+    return order, user_ids, user_starts, scoring[:count]
+
+
+def greedy_gap_points(user_ids, timestamps, gap_seconds=60):
+    """Which messages score under the greedy gap rule: a user's first message scores, and after that a message scores
+    if it's at least gap_seconds after their last scoring message. Channels make no difference. Messages at the same
+    time count in the order given. Returns a boolean array in the same order as user_ids and timestamps, exactly as
+    the message-by-message loop would mark them (given the messages in time order), but vectorised with NumPy.
+
+    It's fastest given arrays (timestamps as datetime64) already sorted by user and then time."""
+    if len(user_ids) == 0:
+        return np.zeros(0, dtype=bool)
+    order, _, _, scoring = _greedy_gap(user_ids, timestamps, gap_seconds)
+    if order is None:
+        return scoring
+    points = np.empty(len(scoring), dtype=bool)
+    points[order] = scoring
+    return points
+
+
+def greedy_gap_scores(user_ids, timestamps, gap_seconds=60):
+    """How many of each user's messages score under greedy_gap_points, as a dict of user_id -> score."""
+    if len(user_ids) == 0:
+        return {}
+    _, user_ids, user_starts, scoring = _greedy_gap(user_ids, timestamps, gap_seconds)
+    scores = np.add.reduceat(scoring, user_starts, dtype=np.int64)
+    return dict(zip(user_ids[user_starts].tolist(), scores.tolist()))
@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import os
+
+from src.helpers.cache_helper import LRUCache
+from src.helpers.metrics_helper import cache_requests
+from src.storage import config
+
+
+def graph_key(kind, ids, group, watermark):
+    """The cache key of a graph: a hash of what was plotted (kind and ids, e.g. "stats" and (guild_id, user_id)), how
+    it was grouped, and a watermark that changes whenever the underlying data does."""
+    return hashlib.sha256(repr((kind, ids, group, watermark)).encode()).hexdigest()
+
+
+class GraphCache:
+    """Rendered graph PNGs, kept in memory (LRU) and on disk under config.graph_cache_path.
+
+    Keys come from graph_key, so an entry never goes stale: once the data moves, the key moves with it. The disk tier
+    outlives restarts. Once it holds more than config.graph_cache_disk_files PNGs, the least recently written are
+    dropped, config.graph_cache_disk_trim more than needed so the next few puts don't trim again. Disk I/O runs in the
+    default executor, off the event loop."""
+    def __init__(self, path=None):
+        self.path = path or config.graph_cache_path
+        os.makedirs(self.path, exist_ok=True)
+        self.memory = LRUCache(config.graph_cache_size, config.graph_cache_ttl, name="graph_memory")
+        # How many PNGs are on disk, counted on the first put rather than scanned on every one.
+        self.disk_files = None
+        self.trimming = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    async def _run(function, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    def file_path(self, key):
+        return os.path.join(self.path, f"{key}.png")
+
+    async def get(self, key):
+        data = self.memory.get(key)
+        if data is None:
+            data = await self._run(self._read, key)
+            if data is not None:
+                self.memory[key] = data
+        self._record(data is not None)
+        return data
+
+    def _read(self, key):
+        try:
+            with open(self.file_path(key), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    async def put(self, key, data):
+        self.memory[key] = data
+        added = await self._run(self._write, key, data)
+        if self.disk_files is None:
+            self.disk_files = await self._run(self._count)
+        elif added:
+            self.disk_files += 1
+        if self.disk_files > config.graph_cache_disk_files and not self.trimming:
+            self.trimming = True
+            try:
+                self.disk_files = await self._run(self.trim)
+            finally:
+                self.trimming = False
+
+    def _write(self, key, data):
+        """Writes the PNG and returns whether it's a new file."""
+        path = self.file_path(key)
+        added = not os.path.exists(path)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, 'wb') as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+        return added
+
+    def _png_entries(self):
+        return [entry for entry in os.scandir(self.path) if entry.name.endswith(".png")]
+
+    def _count(self):
+        return len(self._png_entries())
+
+    def trim(self):
+        """Drops the least recently written PNGs down to config.graph_cache_disk_trim below the limit, and returns how
+        many are left."""
+        entries = self._png_entries()
+        if len(entries) <= config.graph_cache_disk_files:
+            return len(entries)
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        keep = max(config.graph_cache_disk_files - config.graph_cache_disk_trim, 0)
+        for entry in entries[:len(entries) - keep]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        return keep
+
+    def _record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        cache_requests.inc(cache="graphs", result="hit" if hit else "miss")
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / total
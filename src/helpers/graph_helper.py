@@ -1,3 +1,5 @@
+import functools
+
 import humanize
 import pandas
 import matplotlib
@@ -12,11 +14,59 @@ from io import BytesIO
 matplotlib.use("Agg")
 
 
+def init_render_worker():
+    """Runs as each render pool worker starts. Importing this module has already loaded pandas and matplotlib with
+    the Agg backend; drawing one throwaway figure also loads the fonts, so the first real graph doesn't wait on it."""
+    figure = plt.figure()
+    figure.add_subplot().plot([0, 1])
+    figure.savefig(BytesIO())
+    plt.close("all")
+
+
+def ping_render_worker():
+    return True
+
+
+def closes_figures(function):
+    """Render pool workers draw many graphs, so a graph must start and end with no open figures or it would be drawn
+    over the previous one."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        plt.close("all")
+        try:
+            return function(*args, **kwargs)
+        finally:
+            plt.close("all")
+    return wrapper
+
+
+@closes_figures
 def file_from_timestamps(times, group):
-    file = BytesIO()
     series = pandas.Series(times)
     series.index = series.dt.to_period(group)
-    series = series.groupby(level=0).size()
+    return _file_from_period_series(series.groupby(level=0).size(), group)
+
+
+def file_from_shared_timestamps(timestamps, group):
+    """file_from_timestamps for a SharedTimestamps, which arrives in the worker still in shared memory."""
+    try:
+        times = timestamps.to_array("datetime64[ns]")
+    finally:
+        timestamps.close()
+    return file_from_timestamps(times, group)
+
+
+@closes_figures
+def file_from_counts(counts, group):
+    """Like file_from_timestamps, but from (time, count) pairs that have already been counted, such as per-day
+    rollups or per-period counts from the database."""
+    series = pandas.Series([x[1] for x in counts], index=pandas.DatetimeIndex([x[0] for x in counts]))
+    series.index = series.index.to_period(group)
+    return _file_from_period_series(series.groupby(level=0).sum(), group)
+
+
+def _file_from_period_series(series, group):
+    file = BytesIO()
     series = series.reindex(pandas.period_range(series.index.min(), series.index.max(), freq=group), fill_value=0)
     bar_chart = series.plot(subplots=False)
     bar_chart.spines['bottom'].set_position('zero')
@@ -27,6 +77,7 @@ def file_from_timestamps(times, group):
     return file.read()
 
 
+@closes_figures
 def pie_chart_from_amount_and_labels(labels, amounts):
     file = BytesIO()
     amounts = np.array(amounts)
@@ -58,6 +109,7 @@ def format_with_suffix(number, _):
     return str(number) + EXPONENT_SYMBOLS[exponent_place]
 
 
+@closes_figures
 def tfm_graph(flip_data, y_label):
     file = BytesIO()
     series = pandas.Series([x[1] for x in flip_data], index=[x[0] for x in flip_data])
@@ -79,6 +131,7 @@ def num_humanizer(x, pos=0):
     return humanize.intword(x, format="%.2f")
 
 
+@closes_figures
 def plot_multiple(x_label="", y_label="", title="", **kwargs):
     file = BytesIO()
     plt.gca().xaxis.set_major_formatter(dates.DateFormatter("%Y-%m-%d %H:%M"))
@@ -104,6 +157,7 @@ def plot_multiple(x_label="", y_label="", title="", **kwargs):
     return file.read()
 
 
+@closes_figures
 def plot_stats(data, *_, x_label=None, y_label=None, smooth=True):
     file = BytesIO()
     x_values = np.arange(-len(data) + 1, 1, 1)
@@ -127,6 +181,7 @@ def plot_stats(data, *_, x_label=None, y_label=None, smooth=True):
     return file.read()
 
 
+@closes_figures
 def plot_and_extrapolate(input_data, extrapolated_values, *_, x_label=None, y_label=None, smooth=True):
     file = BytesIO()
     x_values = np.arange(-len(input_data) + 1, 1, 1)
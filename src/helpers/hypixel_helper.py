@@ -11,6 +11,7 @@ import datetime
 from scipy.optimize import curve_fit
 from io import BytesIO
 from main import UtilsBot
+from src.helpers.metrics_helper import metrics
 
 EASY_LEVELS = 4
 EASY_LEVELS_XP = 7000
@@ -59,6 +60,10 @@ class HypixelAPI:
         self.ratelimit_reset_time = datetime.datetime.now()
         self.ratelimit_lock = asyncio.Lock()
         self.check_requests_event = asyncio.Event()
+        metrics.gauge("utils_hypixel_queue_depth", "Requests waiting for the Hypixel API.").set_function(
+            self.request_queue.qsize)
+        metrics.gauge("utils_hypixel_ratelimit_remaining", "Hypixel API requests left in this window.").set_function(
+            lambda: self.ratelimit_remaining)
 
     async def safe_request(self, endpoint, parameters=None, prioritize=False):
         returned_json = {}
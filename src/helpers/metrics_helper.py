@@ -0,0 +1,175 @@
+import threading
+
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    formatted = ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                                          .replace("\n", "\\n"))
+                         for name, value in labels)
+    return "{" + formatted + "}"
+
+
+class Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.label_names)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function, **labels):
+        """Reads the gauge's value from function whenever the metrics are scraped."""
+        key = self._key(labels)
+        with self.lock:
+            self.functions[key] = function
+
+    def samples(self):
+        samples = super().samples()
+        with self.lock:
+            functions = list(self.functions.items())
+        for key, function in functions:
+            try:
+                samples.append((self.name, key, function()))
+            except Exception as e:
+                print(f"Could not read gauge {self.name}: {e}")
+        return samples
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            bucket_counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[index] += 1
+            self.values[key] = (bucket_counts, total + value, count + 1)
+
+    def samples(self):
+        samples = []
+        for _, key, (bucket_counts, total, count) in super().samples():
+            for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                samples.append((f"{self.name}_bucket", key + (("le", upper_bound),), bucket_count))
+            samples.append((f"{self.name}_bucket", key + (("le", "+Inf"),), count))
+            samples.append((f"{self.name}_sum", key, total))
+            samples.append((f"{self.name}_count", key, count))
+        return samples
+
+
+class MetricsRegistry:
+    """Holds every metric the bot exposes at /metrics. Registering a name twice returns the existing metric, so
+    reloading a cog doesn't lose or duplicate its metrics."""
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric_class, name, documentation, label_names, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, documentation, label_names, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, documentation, label_names=()) -> Counter:
+        return self._register(Counter, name, documentation, label_names)
+
+    def gauge(self, name, documentation, label_names=()) -> Gauge:
+        return self._register(Gauge, name, documentation, label_names)
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, label_names, buckets=buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+metrics = MetricsRegistry()
+
+gateway_events = metrics.counter("utils_gateway_events_total", "Events dispatched by the gateway, by type.",
+                                 ("event",))
+event_handler_latency = metrics.histogram("utils_event_handler_seconds", "Time spent in event listeners, by cog.",
+                                          ("event", "cog"))
+mongo_latency = metrics.histogram("utils_mongo_command_seconds", "Mongo command latency, by collection.",
+                                  ("command", "collection"))
+mongo_failures = metrics.counter("utils_mongo_command_failures_total", "Failed Mongo commands, by collection.",
+                                 ("command", "collection"))
+cache_requests = metrics.counter("utils_cache_requests_total", "Cache lookups, by cache and hit or miss.",
+                                 ("cache", "result"))
+process_pool_queue_length = metrics.gauge("utils_process_pool_queue_length",
+                                          "Jobs waiting for or running in a worker pool.", ("pool",))
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Records the latency of every command a Mongo client sends, labelled by collection."""
+    def __init__(self):
+        self.running_commands = {}
+
+    def started(self, event):
+        if event.command_name == "getMore":
+            # getMore's own field is the cursor id; the collection has a field of its own.
+            collection_name = event.command.get("collection")
+        else:
+            collection_name = event.command.get(event.command_name)
+        if not isinstance(collection_name, str):
+            collection_name = ""
+        self.running_commands[(event.connection_id, event.request_id)] = f"{event.database_name}.{collection_name}"
+
+    def succeeded(self, event):
+        collection = self.running_commands.pop((event.connection_id, event.request_id), "unknown")
+        mongo_latency.observe(event.duration_micros / 1000000, command=event.command_name, collection=collection)
+
+    def failed(self, event):
+        collection = self.running_commands.pop((event.connection_id, event.request_id), "unknown")
+        mongo_latency.observe(event.duration_micros / 1000000, command=event.command_name, collection=collection)
+        mongo_failures.inc(command=event.command_name, collection=collection)
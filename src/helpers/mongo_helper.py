@@ -1,23 +1,107 @@
 import asyncio
+import copy
 import datetime
 
+import bson
 import discord
 import motor.motor_asyncio
+import numpy as np
 from discord.ext import commands
-from pymongo.errors import BulkWriteError
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
 
+from src.helpers.cache_helper import LRUCache
+from src.helpers.metrics_helper import MongoCommandMetrics
+from src.helpers.timestamp_helper import SharedTimestamps
 from src.storage import config
 from src.storage.token import token
 
+# Indexes that the bot's queries rely on, keyed by (database, collection). Applied by MongoDB.ensure_indexes.
+INDEXES = {
+    ("discord", "messages"): [
+        IndexModel([("user_id", ASCENDING), ("guild_id", ASCENDING), ("created_at", ASCENDING)],
+                   name="user_guild_created_at"),
+        IndexModel([("guild_id", ASCENDING), ("created_at", ASCENDING)], name="guild_created_at"),
+        IndexModel([("channel_id", ASCENDING), ("created_at", DESCENDING)], name="channel_created_at"),
+        IndexModel([("channel_id", ASCENDING), ("deleted", ASCENDING), ("created_at", DESCENDING)],
+                   name="deleted_channel_created_at", partialFilterExpression={"deleted": True}),
+        IndexModel([("content", TEXT)], name="content_text"),
+    ],
+    ("discord", "channels"): [
+        IndexModel([("guild_id", ASCENDING), ("excluded", ASCENDING)], name="guild_excluded"),
+    ],
+    ("discord", "members"): [
+        IndexModel([("_id.guild_id", ASCENDING)], name="guild_id"),
+    ],
+    ("discord", "message_rollups"): [
+        IndexModel([("guild_id", ASCENDING), ("user_id", ASCENDING), ("day", ASCENDING)], name="guild_user_day"),
+        IndexModel([("guild_id", ASCENDING), ("day", ASCENDING)], name="guild_day"),
+    ],
+    ("discord", "loading_stats"): [
+        IndexModel([("guild_id", ASCENDING)], name="guild_id"),
+    ],
+    ("hypixel", "statistics"): [
+        IndexModel([("uuid", ASCENDING), ("timestamp", DESCENDING)], name="uuid_timestamp"),
+    ],
+    ("hypixel", "players"): [
+        IndexModel([("channels", ASCENDING)], name="channels"),
+        IndexModel([("discord_id", ASCENDING)], name="discord_id"),
+    ],
+    ("skyblock", "auctions"): [
+        IndexModel([("item_name", ASCENDING), ("bin", ASCENDING), ("sold", ASCENDING), ("tier", ASCENDING)],
+                   name="item_name_bin_sold_tier"),
+        IndexModel([("item_name", TEXT)], name="item_name_text"),
+    ],
+}
+
+# Example shapes of the hottest queries, explained by index_report to catch any that fall back to a collection scan.
+HOT_QUERIES = [
+    ("discord", "messages", {"user_id": 0, "guild_id": 0}, [("created_at", ASCENDING)]),
+    ("discord", "messages", {"deleted": True, "channel_id": 0}, [("created_at", DESCENDING)]),
+    ("discord", "messages", {"guild_id": 0, "created_at": {"$gt": datetime.datetime(2015, 1, 1)}},
+     [("created_at", ASCENDING)]),
+    ("discord", "messages", {"$text": {"$search": "monkey"}, "guild_id": 0}, None),
+    ("discord", "channels", {"excluded": True, "guild_id": 0}, None),
+    ("discord", "message_rollups", {"guild_id": 0, "user_id": 0}, None),
+    ("hypixel", "statistics", {"uuid": ""}, [("timestamp", DESCENDING)]),
+    ("hypixel", "players", {"channels": 0}, None),
+    ("skyblock", "auctions", {"item_name": {"$in": [""]}, "bin": True, "sold": True, "count": 1}, None),
+]
+
+# Fields every message document has, and the values compact documents leave out.
+MESSAGE_DEFAULTS = {"embeds": [], "deleted": False, "edits": [], "mentions": [], "role_mentions": [],
+                    "mention_everyone": False}
+# Matches messages that aren't deleted, whether or not the document stores "deleted": False.
+NOT_DELETED = {"$ne": True}
+# A {"t": <int64>} document as raw BSON: its length, the int64 type byte (0x12), the key "t", the value and the
+# terminating 0.
+RAW_TIMESTAMP_DTYPE = np.dtype([("length", "<i4"), ("type", "u1"), ("key", "S2"), ("value", "<i8"), ("end", "u1")])
+# The $dateTrunc unit for each of the graph groupings.
+DATE_TRUNC_UNITS = {'d': "day", 'w': "week", 'm': "month", 'y': "year"}
+
 
 class MongoDB:
     def __init__(self, read_only=False):
         if read_only:
             self.client = motor.motor_asyncio.AsyncIOMotorClient(config.mongo_connection_uri +
-                                                                 "&readPreference=secondaryPreferred")
+                                                                 "&readPreference=secondaryPreferred",
+                                                                 event_listeners=[MongoCommandMetrics()])
         else:
-            self.client = motor.motor_asyncio.AsyncIOMotorClient(config.mongo_connection_uri)
+            self.client = motor.motor_asyncio.AsyncIOMotorClient(config.mongo_connection_uri,
+                                                                 event_listeners=[MongoCommandMetrics()])
         self.discord_db = self.client.discord
+        # Entities known to already be stored, so message ingestion doesn't need to check for them again.
+        # known_channels maps channel id -> that channel's nostore flag.
+        self.known_guilds = LRUCache(config.known_entity_cache_size, config.known_entity_ttl,
+                                     name="known_guilds")
+        self.known_channels = LRUCache(config.known_entity_cache_size, config.known_entity_ttl,
+                                       name="known_channels")
+        self.known_users = LRUCache(config.known_entity_cache_size, config.known_entity_ttl,
+                                    name="known_users")
+        self.known_members = LRUCache(config.known_entity_cache_size, config.known_entity_ttl,
+                                      name="known_members")
+        # Background lookups of entities that aren't known, by key, so each only runs once at a time.
+        self.entity_lookups = {}
 
     @staticmethod
     async def force_insert(collection, document):
@@ -33,37 +117,203 @@ class MongoDB:
             return {}
         return result
 
+    async def ensure_indexes(self):
+        """Creates any missing indexes from INDEXES and verifies that existing ones match.
+        Returns a list of problems found."""
+        problems = []
+        for (database_name, collection_name), indexes in INDEXES.items():
+            collection = self.client[database_name][collection_name]
+            existing_indexes = await collection.index_information()
+            existing_by_key = {tuple(info["key"]): info for info in existing_indexes.values()}
+            # A collection can only have one text index, whatever it is called.
+            has_text_index = any(direction == TEXT for info in existing_indexes.values()
+                                 for _, direction in info["key"])
+            for index in indexes:
+                index_document = index.document
+                key = tuple(index_document["key"].items())
+                if any(direction == TEXT for _, direction in key):
+                    if not has_text_index:
+                        problems += await self._create_index(collection, index)
+                    continue
+                existing_index = existing_by_key.get(key)
+                if existing_index is None:
+                    problems += await self._create_index(collection, index)
+                elif existing_index.get("partialFilterExpression") != index_document.get("partialFilterExpression"):
+                    problems.append(f"{database_name}.{collection_name}: index on {key} has a different "
+                                    f"partial filter than expected.")
+        for problem in problems:
+            print(problem)
+        return problems
+
+    @staticmethod
+    async def _create_index(collection, index):
+        try:
+            await collection.create_indexes([index])
+        except OperationFailure as e:
+            return [f"{collection.full_name}: could not create index {index.document['name']}: {e}"]
+        print(f"Created index {index.document['name']} on {collection.full_name}.")
+        return []
+
+    async def index_report(self):
+        """Returns the access counts of every index on the registered collections, and the hot queries whose
+        winning plan is a collection scan."""
+        usage = {}
+        for database_name, collection_name in INDEXES:
+            collection = self.client[database_name][collection_name]
+            index_stats = await collection.aggregate([{"$indexStats": {}}]).to_list(length=None)
+            usage[collection.full_name] = {x["name"]: x["accesses"]["ops"] for x in index_stats}
+        collection_scans = []
+        for database_name, collection_name, query, sort in HOT_QUERIES:
+            cursor = self.client[database_name][collection_name].find(query)
+            if sort is not None:
+                cursor = cursor.sort(sort)
+            explanation = await cursor.explain()
+            if "COLLSCAN" in str(explanation.get("queryPlanner", {}).get("winningPlan", {})):
+                collection_scans.append(f"{database_name}.{collection_name} {query}")
+        return usage, collection_scans
+
+    @staticmethod
+    def _make_guild_document(guild: discord.Guild):
+        return {"_id": guild.id, "name": guild.name, "removed": False, "stats": True}
+
+    @staticmethod
+    def _make_channel_document(channel: discord.TextChannel):
+        # "excluded" is only set when the channel is first stored, so updates don't undo exclude_channel.
+        return {"_id": channel.id, "name": channel.name, "guild_id": channel.guild.id, "deleted": False}
+
+    @staticmethod
+    def _make_user_document(user: discord.User):
+        return {"_id": user.id, "name": user.name, "discriminator": user.discriminator, "bot": user.bot,
+                "avatar_hash": user.avatar}
+
+    @staticmethod
+    def _make_member_document(member: discord.Member):
+        return {"_id": {"user_id": member.id, "guild_id": member.guild.id},
+                "nick": member.nick, "joined_at": member.joined_at, "deleted": False}
+
     async def insert_guild(self, guild: discord.Guild):
-        guild_document = {"_id": guild.id, "name": guild.name, "removed": False, "stats": True}
+        guild_document = self._make_guild_document(guild)
         await self.force_insert(self.discord_db.guilds, guild_document)
+        self.known_guilds[guild.id] = True
         return guild_document
 
-    async def insert_channel(self, channel: discord.TextChannel):
-        guild_result = await self.discord_db.guilds.find_one({"_id": channel.guild.id})
+    async def ensure_guild(self, guild: discord.Guild):
+        if guild.id in self.known_guilds:
+            return
+        guild_result = await self.discord_db.guilds.find_one({"_id": guild.id}, projection={"_id": True})
         if guild_result is None:
-            await self.insert_guild(channel.guild)
-        channel_document = {"_id": channel.id, "name": channel.name, "guild_id": channel.guild.id, "deleted": False,
-                            "excluded": False}
-        await self.force_insert(self.discord_db.channels, channel_document)
+            await self.insert_guild(guild)
+        else:
+            self.known_guilds[guild.id] = True
+
+    async def insert_channel(self, channel: discord.TextChannel):
+        await self.ensure_guild(channel.guild)
+        channel_document = self._make_channel_document(channel)
+        stored_document = await self.discord_db.channels.find_one_and_update({"_id": channel.id},
+                                                                             {"$set": channel_document,
+                                                                              "$setOnInsert": {"excluded": False}},
+                                                                             upsert=True,
+                                                                             return_document=ReturnDocument.AFTER)
+        self.known_channels[channel.id] = stored_document.get("nostore", False)
+        return stored_document
 
     async def insert_user(self, user: discord.User):
-        user_document = {"_id": user.id, "name": user.name, "discriminator": user.discriminator, "bot": user.bot,
-                         "avatar_hash": user.avatar}
+        user_document = self._make_user_document(user)
         await self.force_insert(self.discord_db.users, user_document)
+        self.known_users[user.id] = True
 
     async def insert_member(self, member: discord.Member):
         if isinstance(member, discord.User):
             return
-        user_result = await self.discord_db.users.find_one({"_id": member.id})
-        if user_result is None:
-            # noinspection PyTypeChecker
-            await self.insert_user(member)
-        guild_result = await self.discord_db.guilds.find_one({"_id": member.guild.id})
-        if guild_result is None:
-            await self.insert_guild(member.guild)
-        member_document = {"_id": {"user_id": member.id, "guild_id": member.guild.id},
-                           "nick": member.nick, "joined_at": member.joined_at, "deleted": False}
+        if member.id not in self.known_users:
+            user_result = await self.discord_db.users.find_one({"_id": member.id}, projection={"_id": True})
+            if user_result is None:
+                # noinspection PyTypeChecker
+                await self.insert_user(member)
+            else:
+                self.known_users[member.id] = True
+        await self.ensure_guild(member.guild)
+        member_document = self._make_member_document(member)
         await self.force_insert(self.discord_db.members, member_document)
+        self.known_members[(member.guild.id, member.id)] = True
+
+    @staticmethod
+    def _stored_value_equal(stored_value, value):
+        if isinstance(value, datetime.datetime) and isinstance(stored_value, datetime.datetime):
+            # Mongo stores naive UTC datetimes with millisecond precision.
+            if value.tzinfo is not None:
+                value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            return stored_value.replace(tzinfo=None) == value.replace(microsecond=value.microsecond // 1000 * 1000)
+        return stored_value == value
+
+    async def bulk_upsert_changed(self, collection, documents, set_on_insert=None):
+        """Upserts documents with chunked unordered bulk writes, skipping any whose stored fields are all unchanged.
+        Returns the number of documents written."""
+        written = 0
+        chunk_size = config.bulk_sync_chunk_size
+        for chunk_start in range(0, len(documents), chunk_size):
+            chunk = documents[chunk_start:chunk_start + chunk_size]
+            stored_documents = await self.find_by_ids(collection, [x["_id"] for x in chunk])
+            requests = []
+            for document in chunk:
+                stored_document = stored_documents.get(self.hashable_id(document["_id"]))
+                if stored_document is not None and all(self._stored_value_equal(stored_document.get(key), value)
+                                                       for key, value in document.items()):
+                    continue
+                update = {"$set": document}
+                if set_on_insert is not None:
+                    update["$setOnInsert"] = set_on_insert
+                requests.append(UpdateOne({"_id": document["_id"]}, update, upsert=True))
+            if len(requests) == 0:
+                continue
+            try:
+                await collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                print(f"Bulk sync of {collection.name} had {len(e.details.get('writeErrors', []))} write errors.")
+            written += len(requests)
+        return written
+
+    @staticmethod
+    def hashable_id(document_id):
+        """Dict _ids (like members') can't be dict keys, so they're keyed by a tuple of their items."""
+        if isinstance(document_id, dict):
+            return tuple(document_id.items())
+        return document_id
+
+    async def find_by_ids(self, collection, ids, projection=None):
+        """Fetches every document with one of ids as its _id in a single query. Returns a dict of
+        hashable_id(_id) -> document, leaving out ids that aren't stored."""
+        documents = {}
+        if len(ids) == 0:
+            return documents
+        async for document in collection.find({"_id": {"$in": list(ids)}}, projection):
+            documents[self.hashable_id(document["_id"])] = document
+        return documents
+
+    async def bulk_sync_guild(self, guild: discord.Guild, channels, members):
+        """Stores a guild along with its text channels and members (and their users) using bulk writes.
+        Returns the number of documents written."""
+        channels = [channel for channel in channels if isinstance(channel, discord.TextChannel)]
+        members = [member for member in members if isinstance(member, discord.Member)]
+        written = await self.bulk_upsert_changed(self.discord_db.guilds, [self._make_guild_document(guild)])
+        written += await self.bulk_upsert_changed(self.discord_db.channels,
+                                                  [self._make_channel_document(x) for x in channels],
+                                                  set_on_insert={"excluded": False})
+        written += await self.bulk_upsert_changed(self.discord_db.users,
+                                                  [self._make_user_document(x) for x in members])
+        written += await self.bulk_upsert_changed(self.discord_db.members,
+                                                  [self._make_member_document(x) for x in members])
+        self.known_guilds[guild.id] = True
+        for member in members:
+            self.known_users[member.id] = True
+            self.known_members[(guild.id, member.id)] = True
+        return written
+
+    def forget_channel(self, channel_id):
+        self.known_channels.pop(channel_id)
+
+    def forget_member(self, guild_id, user_id):
+        self.known_members.pop((guild_id, user_id))
 
     @staticmethod
     def _make_message_document(message):
@@ -73,20 +323,265 @@ class MongoDB:
                             "deleted": False, "edits": [], "mentions": [x.id for x in message.mentions],
                             "role_mentions": [x.id for x in message.role_mentions],
                             "mention_everyone": message.mention_everyone}
+        if config.compact_messages:
+            message_document = {key: value for key, value in message_document.items()
+                                if key not in MESSAGE_DEFAULTS or value != MESSAGE_DEFAULTS[key]}
         return message_document
 
+    @staticmethod
+    def expand_message(message_document):
+        """Fills in any fields a compact message document left out, so readers don't need to care which it is."""
+        if message_document is None:
+            return None
+        expanded_document = copy.deepcopy(MESSAGE_DEFAULTS)
+        expanded_document.update(message_document)
+        return expanded_document
+
+    async def compact_message_batch(self, after_id, batch_size):
+        """Removes default-valued fields from the next batch_size messages after after_id.
+        Returns the last _id in the batch (None once there are no more messages) and how many were rewritten."""
+        query = self.discord_db.messages.find({"_id": {"$gt": after_id}}, projection={"_id": True})
+        query.sort("_id", 1).limit(batch_size)
+        message_ids = [x["_id"] for x in await query.to_list(length=batch_size)]
+        if len(message_ids) == 0:
+            return None, 0
+        compacted_fields = {field: {"$cond": [{"$eq": [f"${field}", {"$literal": default}]}, "$$REMOVE", f"${field}"]}
+                            for field, default in MESSAGE_DEFAULTS.items()}
+        result = await self.discord_db.messages.update_many({"_id": {"$in": message_ids}},
+                                                            [{"$set": compacted_fields}])
+        return message_ids[-1], result.modified_count
+
+    def prepare_message(self, message: discord.Message):
+        """Returns the message's document, without waiting on Mongo, and None in its place if the channel is marked
+        as nostore. A channel or author that isn't known to be stored is looked up (and stored) in the background.
+
+        A nostore flag that has expired from known_channels is still used until it's read again. If the channel's
+        flag has never been read, the document comes back along with the task reading it, and mustn't be stored
+        unless that resolves to False: it resolves to None if Mongo couldn't be asked. Otherwise that's None."""
+        channel_id = message.channel.id
+        nostore = self.known_channels.peek(channel_id, allow_expired=True)
+        channel_lookup = None
+        if channel_id not in self.known_channels:
+            channel_lookup = self._lookup(("channel", channel_id), self._ensure_channel, message.channel)
+        if nostore:
+            return None, None
+        # Webhooks and users who have left aren't members, so there's nothing to look up.
+        member_key = (message.guild.id, message.author.id)
+        if isinstance(message.author, discord.Member) and member_key not in self.known_members:
+            self._lookup(("member",) + member_key, self._ensure_member, message)
+        if nostore is None:
+            return self._make_message_document(message), channel_lookup
+        return self._make_message_document(message), None
+
+    def _lookup(self, key, function, *args):
+        """Runs function(*args) in the background unless it's already running for key, and returns its task."""
+        task = self.entity_lookups.get(key)
+        if task is None:
+            task = asyncio.get_event_loop().create_task(self._run_lookup(key, function, *args))
+            self.entity_lookups[key] = task
+        return task
+
+    async def _run_lookup(self, key, function, *args):
+        try:
+            return await asyncio.wait_for(function(*args), config.mongo_slow_timeout)
+        except (asyncio.TimeoutError, PyMongoError) as e:
+            print(f"Couldn't look up {key} in Mongo: {e!r}")
+            return None
+        finally:
+            self.entity_lookups.pop(key, None)
+
+    async def _ensure_channel(self, channel: discord.TextChannel):
+        """Makes sure the channel is stored. Returns its nostore flag."""
+        nostore = self.known_channels.get(channel.id)
+        if nostore is None:
+            channel_result = await self.discord_db.channels.find_one({"_id": channel.id},
+                                                                     projection={"nostore": True})
+            if channel_result is None:
+                channel_result = await self.insert_channel(channel)
+            nostore = channel_result.get("nostore", False)
+            self.known_channels[channel.id] = nostore
+        return nostore
+
+    async def _ensure_member(self, message: discord.Message):
+        if not isinstance(message.author, discord.Member):
+            return
+        member_key = (message.guild.id, message.author.id)
+        if member_key not in self.known_members:
+            member_result = await self.discord_db.members.find_one({"_id": {"user_id": message.author.id,
+                                                                            "guild_id": message.guild.id}},
+                                                                   projection={"_id": True})
+            if member_result is None:
+                await self.insert_member(message.author)
+            else:
+                self.known_members[member_key] = True
+
+    async def without_nostore(self, message_documents):
+        """The message documents whose channels aren't marked as nostore."""
+        channel_ids = list(set(message_document["channel_id"] for message_document in message_documents))
+        nostore_channels = set(await self.discord_db.channels.distinct("_id", {"_id": {"$in": channel_ids},
+                                                                               "nostore": True}))
+        return [message_document for message_document in message_documents
+                if message_document["channel_id"] not in nostore_channels]
+
     async def insert_message(self, message: discord.Message):
-        channel_result = await self.discord_db.channels.find_one({"_id": message.channel.id})
-        if channel_result is None:
-            await self.insert_channel(message.channel)
-        else:
-            if channel_result.get("nostore", False):
-                return
-        member_result = await self.discord_db.members.find_one({"_id": message.author.id})
-        if member_result is None:
-            await self.insert_member(message.author)
+        if await self._ensure_channel(message.channel):
+            return
+        await self._ensure_member(message)
         message_document = self._make_message_document(message)
-        await self.force_insert(self.discord_db.messages, message_document)
+        result = await self.discord_db.messages.update_one({"_id": message_document["_id"]},
+                                                           {"$set": message_document}, upsert=True)
+        if result.upserted_id is not None:
+            await self.increment_rollups([message_document])
+
+    @staticmethod
+    def _rollup_id(message_document):
+        created_at = message_document["created_at"]
+        return {"guild_id": message_document["guild_id"], "user_id": message_document["user_id"],
+                "channel_id": message_document["channel_id"],
+                "day": datetime.datetime(created_at.year, created_at.month, created_at.day)}
+
+    async def increment_rollups(self, message_documents):
+        """Adds newly stored messages to the per (guild, user, channel, day) counts in message_rollups. Only pass
+        messages that have just been inserted, or they'll be counted twice.
+
+        This can only ever undercount: if it fails after the messages were written, or a write that timed out (and
+        was spooled) had in fact landed, those messages are never added. recount_rollups puts that right for days
+        that are over."""
+        counts = {}
+        rollup_ids = {}
+        for message_document in message_documents:
+            rollup_id = self._rollup_id(message_document)
+            rollup_key = self.hashable_id(rollup_id)
+            counts[rollup_key] = counts.get(rollup_key, 0) + 1
+            rollup_ids[rollup_key] = rollup_id
+        if len(counts) == 0:
+            return
+        requests = [UpdateOne({"_id": rollup_ids[rollup_key]}, {"$inc": {"count": count},
+                                                                 "$setOnInsert": rollup_ids[rollup_key]}, upsert=True)
+                    for rollup_key, count in counts.items()]
+        await self.discord_db.message_rollups.bulk_write(requests, ordered=False)
+
+    async def recount_rollups(self, guild_id, since=None, until=None):
+        """Replaces a guild's message_rollups with counts of its stored messages, for every day or just those from
+        since up to (not including) until, which should both be midnights. Messages written while this runs may be
+        counted twice or not at all, so leave out days that are still getting messages."""
+        day = {"$dateFromParts": {"year": {"$year": "$created_at"}, "month": {"$month": "$created_at"},
+                                  "day": {"$dayOfMonth": "$created_at"}}}
+        match = {"guild_id": guild_id}
+        if since is not None or until is not None:
+            match["created_at"] = {}
+            if since is not None:
+                match["created_at"]["$gte"] = since
+            if until is not None:
+                match["created_at"]["$lt"] = until
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": {"guild_id": "$guild_id", "user_id": "$user_id", "channel_id": "$channel_id",
+                                "day": day},
+                        "count": {"$sum": 1}}},
+            {"$addFields": {"guild_id": "$_id.guild_id", "user_id": "$_id.user_id", "channel_id": "$_id.channel_id",
+                            "day": "$_id.day"}},
+            {"$merge": {"into": "message_rollups", "on": "_id", "whenMatched": "replace",
+                        "whenNotMatched": "insert"}},
+        ]
+        await self.discord_db.messages.aggregate(pipeline, allowDiskUse=True).to_list(length=None)
+
+    async def backfill_rollups(self, guild_id):
+        """Rebuilds a guild's message_rollups from every stored message, then marks the guild's rollups as ready.
+        Messages written while this is running may be counted twice or not at all, until recount_rollups next
+        covers their day."""
+        await self.recount_rollups(guild_id)
+        await self.discord_db.rollup_state.update_one({"_id": guild_id},
+                                                      {"$set": {"backfilled": True,
+                                                                "backfilled_at": datetime.datetime.utcnow()}},
+                                                      upsert=True)
+
+    async def rollups_ready(self, guild_id):
+        rollup_state = await self.discord_db.rollup_state.find_one({"_id": guild_id})
+        return rollup_state is not None and rollup_state.get("backfilled", False)
+
+    async def daily_message_counts(self, match):
+        """(day, count) for every day with messages matching match, read from message_rollups."""
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": "$day", "count": {"$sum": "$count"}}},
+        ]
+        aggregation = self.discord_db.message_rollups.aggregate(pipeline)
+        return [(x.get("_id"), x.get("count")) for x in await aggregation.to_list(length=None)]
+
+    async def bucketed_message_counts(self, match, group):
+        """(period start, count) for messages matching match, counted per day, week, month or year on the server so
+        only one document per period is sent back. $dateTrunc needs MongoDB 5.0; older servers raise
+        OperationFailure."""
+        date_trunc = {"date": "$created_at", "unit": DATE_TRUNC_UNITS[group]}
+        if group == 'w':
+            # Matches the weeks pandas groups into.
+            date_trunc["startOfWeek"] = "monday"
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": {"$dateTrunc": date_trunc}, "count": {"$sum": 1}}},
+        ]
+        aggregation = self.discord_db.messages.aggregate(pipeline, allowDiskUse=True)
+        return [(x.get("_id"), x.get("count")) for x in await aggregation.to_list(length=None)]
+
+    async def load_timestamps(self, match) -> SharedTimestamps:
+        """Streams the created_at of every message matching match into shared memory, one raw BSON batch at a time,
+        so only a batch is ever held at once and no Python object is made per message. The caller must close()
+        what's returned."""
+        timestamps = SharedTimestamps()
+        try:
+            pipeline = [
+                {"$match": match},
+                {"$project": {"_id": 0, "t": {"$toLong": "$created_at"}}},
+            ]
+            cursor = self.discord_db.messages.aggregate_raw_batches(pipeline, allowDiskUse=True,
+                                                                    batchSize=config.timestamp_batch_size)
+            async for batch in cursor:
+                timestamps.extend(self._raw_timestamps(batch))
+        except BaseException:
+            timestamps.close()
+            raise
+        return timestamps
+
+    @staticmethod
+    def _raw_timestamps(batch):
+        """The timestamps in a raw batch of {"t": created_at as milliseconds} documents, read straight from the BSON
+        when every document has the same layout."""
+        if len(batch) % RAW_TIMESTAMP_DTYPE.itemsize == 0:
+            documents = np.frombuffer(batch, dtype=RAW_TIMESTAMP_DTYPE)
+            if np.all(documents["length"] == RAW_TIMESTAMP_DTYPE.itemsize) and np.all(documents["type"] == 0x12):
+                return documents["value"].astype("datetime64[ms]")
+        # A message without a created_at gives a null instead of a long, so the documents aren't all alike.
+        milliseconds = [document["t"] for document in bson.decode_all(batch) if document.get("t") is not None]
+        return np.array(milliseconds, dtype=np.int64).astype("datetime64[ms]")
+
+    async def save_leaderboard_snapshot(self, guild_id, week_start, scores):
+        """Stores a guild's final leaderboard for the week starting at week_start. Snapshots are never overwritten,
+        so returns False if the week already has one."""
+        snapshot_document = {"_id": {"guild_id": guild_id, "week_start": week_start}, "guild_id": guild_id,
+                             "week_start": week_start, "taken_at": datetime.datetime.utcnow(),
+                             "scores": [[user_id, score] for user_id, score in scores]}
+        try:
+            await self.discord_db.leaderboard_snapshots.insert_one(snapshot_document)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def get_leaderboard_snapshot(self, guild_id, week_start):
+        return await self.discord_db.leaderboard_snapshots.find_one({"_id": {"guild_id": guild_id,
+                                                                             "week_start": week_start}})
+
+    async def get_backfill_checkpoint(self, channel_id):
+        return await self.discord_db.backfill_checkpoints.find_one({"_id": channel_id})
+
+    async def save_backfill_checkpoint(self, channel, last_id, target_id, completed=False):
+        """Records that every message in channel up to and including last_id has been stored. last_id only ever
+        moves forwards, so a late write from an older batch can't rewind the checkpoint."""
+        await self.discord_db.backfill_checkpoints.update_one({"_id": channel.id},
+                                                              {"$set": {"guild_id": channel.guild.id,
+                                                                        "target_id": target_id,
+                                                                        "completed": completed},
+                                                               "$max": {"last_id": last_id}}, upsert=True)
 
     async def insert_channel_messages(self, list_of_messages):
         """Requires that all messages be from the same channel"""
@@ -114,31 +609,49 @@ class MongoDB:
             await self.discord_db.channels.insert_many(channel_documents, ordered=False)
         except BulkWriteError:
             pass
+        inserted_documents = message_documents
         try:
             await self.discord_db.messages.insert_many(message_documents, ordered=False)
-        except BulkWriteError:
-            pass
+        except BulkWriteError as e:
+            failed_indexes = set(error["index"] for error in e.details.get("writeErrors", []))
+            inserted_documents = [document for index, document in enumerate(message_documents)
+                                  if index not in failed_indexes]
+        await self.increment_rollups(inserted_documents)
 
-    async def message_edit(self, payload: discord.RawMessageUpdateEvent):
-        is_bot = payload.data.get("author", {}).get("bot", False)
+    @staticmethod
+    def edit_from_payload(payload: discord.RawMessageUpdateEvent):
+        """The parts of an edit event that message_edit stores, or None if the event isn't an edit to store."""
         last_edited = payload.data.get('edited_timestamp')
         if last_edited is None:
             return None
-        timestamp = datetime.datetime.fromisoformat(last_edited)
-        message_document = await self.discord_db.messages.find_one({"_id": payload.message_id})
-        if message_document is None:
-            return
-        old_edits = sorted(message_document.get("edits", []), key=lambda x: x.get("timestamp"))
-        if len(old_edits) > 10 and is_bot:
-            return
-        edit_document = {"timestamp": timestamp, "content": payload.data.get("content", None),
-                         "embeds": payload.data.get("embeds", [])}
-        if len(old_edits) > 0 and old_edits[-1].get("timestamp").replace(tzinfo=datetime.timezone.utc) \
-                > timestamp - datetime.timedelta(seconds=0.5):
-            old_edits[-1] = edit_document
-        else:
-            old_edits.append(edit_document)
-        await self.discord_db.messages.update_one({"_id": payload.message_id}, {'$set': {"edits": old_edits}})
+        return {"_id": payload.message_id, "timestamp": datetime.datetime.fromisoformat(last_edited),
+                "content": payload.data.get("content", None), "embeds": payload.data.get("embeds", []),
+                "is_bot": payload.data.get("author", {}).get("bot", False)}
+
+    async def message_edit(self, payload: discord.RawMessageUpdateEvent):
+        edit = self.edit_from_payload(payload)
+        if edit is not None:
+            await self.apply_edit(edit)
+
+    async def apply_edit(self, edit):
+        timestamp = edit["timestamp"]
+        edit_document = {"timestamp": timestamp, "content": edit["content"], "embeds": edit["embeds"]}
+        # The edit is applied by the server in a single update, so concurrent edits can't overwrite each other.
+        # $literal stops content like "$5" being read as a field path.
+        new_edit = [{"$literal": edit_document}]
+        edit_count = {"$size": "$$edits"}
+        replaces_last_edit = {"$and": [{"$gt": [edit_count, 0]},
+                                       {"$gt": [{"$arrayElemAt": ["$$edits.timestamp", -1]},
+                                                timestamp - datetime.timedelta(seconds=0.5)]}]}
+        updated_edits = {"$cond": [replaces_last_edit,
+                                   {"$concatArrays": [{"$slice": ["$$edits", {"$subtract": [edit_count, 1]}]},
+                                                      new_edit]},
+                                   {"$concatArrays": ["$$edits", new_edit]}]}
+        if edit["is_bot"]:
+            updated_edits = {"$cond": [{"$gt": [edit_count, 10]}, "$$edits", updated_edits]}
+        pipeline = [{"$set": {"edits": {"$let": {"vars": {"edits": {"$ifNull": ["$edits", []]}},
+                                                 "in": updated_edits}}}}]
+        await self.discord_db.messages.update_one({"_id": edit["_id"]}, pipeline)
 
     @staticmethod
     async def find_by_column(collection, column, value):
@@ -0,0 +1,47 @@
+import asyncio
+
+import discord
+
+from src.helpers.cache_helper import LRUCache
+from src.storage import config
+
+
+class NameResolver:
+    """Turns user ids into display names for a guild with as few lookups as possible: the member cache first,
+    then one query for the stored users, and only then concurrent fetches from Discord for whatever is left.
+    Names of users who aren't in the member cache are cached for config.name_cache_ttl seconds."""
+    def __init__(self, bot):
+        self.bot = bot
+        self.names = LRUCache(config.name_cache_size, config.name_cache_ttl, name="display_names")
+
+    async def resolve(self, guild: discord.Guild, user_ids):
+        names = {}
+        missing = []
+        for user_id in user_ids:
+            member = guild.get_member(user_id)
+            if member is not None:
+                names[user_id] = member.nick or member.name
+                continue
+            name = self.names.get(user_id)
+            if name is not None:
+                names[user_id] = name
+                continue
+            missing.append(user_id)
+        if len(missing) > 0:
+            user_documents = await self.bot.mongo.find_by_ids(self.bot.mongo.discord_db.users, missing, {"name": 1})
+            for user_id, user_document in user_documents.items():
+                if user_document.get("name") is not None:
+                    names[user_id] = user_document["name"]
+            to_fetch = [user_id for user_id in missing if user_id not in names]
+            fetched_names = await asyncio.gather(*[self.fetch_name(user_id) for user_id in to_fetch])
+            names.update(zip(to_fetch, fetched_names))
+            for user_id in missing:
+                self.names[user_id] = names[user_id]
+        return names
+
+    async def fetch_name(self, user_id):
+        try:
+            user = await self.bot.fetch_user(user_id)
+        except discord.errors.HTTPException:
+            return "Unknown Member"
+        return user.name
@@ -0,0 +1,144 @@
+import asyncio
+import concurrent.futures
+import time
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from src.helpers.metrics_helper import metrics, process_pool_queue_length
+from src.storage import config
+
+job_latency = metrics.histogram("utils_worker_job_seconds", "Time from submitting a job to a worker pool until it "
+                                                            "finishes.", ("pool", "job"))
+pool_healthy = metrics.gauge("utils_worker_pool_healthy", "Whether the pool's last health check passed.", ("pool",))
+pool_rejections = metrics.counter("utils_worker_pool_rejections_total", "Jobs turned away because the pool's queue "
+                                                                        "was full.", ("pool",))
+
+
+def warm_up():
+    """A job that does nothing, so a worker process starts (and runs its initializer) before real work arrives."""
+    return None
+
+
+class PoolBusy(Exception):
+    """Raised by WorkerPool.run when the pool already has max_queue jobs waiting or running."""
+    def __init__(self, pool_name):
+        super().__init__(f"Worker pool {pool_name} is full.")
+        self.pool_name = pool_name
+
+
+class WorkerPool:
+    """A long-lived process pool, so jobs don't pay for spawning processes and re-importing modules every time.
+
+    initializer runs once in every worker process as it starts. health_check is a function run in a worker
+    every config.worker_health_interval seconds; if it fails or times out, the pool is replaced. If max_queue is set,
+    run raises PoolBusy once that many jobs are waiting or running, and run_when_free waits for room instead. The last
+    reserved places in the queue are kept for run, so background work can't fill it and turn users away."""
+    def __init__(self, name, size, initializer=None, health_check=None, max_queue=None, reserved=0):
+        self.name = name
+        self.size = size
+        self.initializer = initializer
+        self.health_check = health_check
+        self.max_queue = max_queue
+        self.reserved = reserved
+        self.executor = self._make_executor()
+        self.jobs = 0
+        self.job_finished = asyncio.Event()
+        self.healthy = True
+        self.health_task = None
+        process_pool_queue_length.set_function(lambda: self.jobs, pool=name)
+        pool_healthy.set_function(lambda: int(self.healthy), pool=name)
+
+    def _make_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.size, initializer=self.initializer)
+
+    def full(self, reserved=0):
+        return self.max_queue is not None and self.jobs >= self.max_queue - reserved
+
+    async def run(self, function, *args, **kwargs):
+        if self.full():
+            pool_rejections.inc(pool=self.name)
+            raise PoolBusy(self.name)
+        return await self._run(function, *args, **kwargs)
+
+    async def run_when_free(self, function, *args, **kwargs):
+        """Like run, but waits for room in the queue (outside the reserved places) rather than raising PoolBusy. For
+        background work."""
+        while self.full(self.reserved):
+            self.job_finished.clear()
+            await self.job_finished.wait()
+        return await self._run(function, *args, **kwargs)
+
+    async def _run(self, function, *args, **kwargs):
+        self.jobs += 1
+        try:
+            return await self._execute(function, *args, **kwargs)
+        finally:
+            self.jobs -= 1
+            self.job_finished.set()
+
+    async def _execute(self, function, *args, **kwargs):
+        start = time.perf_counter()
+        executor = self.executor
+        try:
+            return await asyncio.get_event_loop().run_in_executor(executor, partial(function, *args, **kwargs))
+        except BrokenProcessPool:
+            # Only the first job to notice replaces the pool.
+            if self.executor is executor:
+                self.restart()
+            raise
+        finally:
+            job_latency.observe(time.perf_counter() - start, pool=self.name, job=function.__name__)
+
+    def start(self):
+        """Starts every worker now rather than on its first job, then starts the health checks."""
+        if self.health_task is not None:
+            return
+        self.warm()
+        self.health_task = asyncio.get_event_loop().create_task(self.check_health_forever())
+
+    async def check_health(self):
+        """Pings every worker while the pool is idle. A busy pool is skipped: its pings would only queue behind the
+        jobs and time out, and replacing a pool that's working wouldn't fix anything. Pings don't count as jobs, so
+        they can't fill the queue. A broken pool is replaced by whichever job notices first."""
+        if self.health_check is None or self.jobs > 0:
+            return self.healthy
+        try:
+            checks = [self._execute(self.health_check) for _ in range(self.size)]
+            await asyncio.wait_for(asyncio.gather(*checks), config.worker_health_timeout)
+            self.healthy = True
+        except asyncio.TimeoutError:
+            if self.jobs > 0:
+                # Jobs arrived during the check and the pings are stuck behind them, which says nothing.
+                return self.healthy
+            print(f"Worker pool {self.name} didn't answer its health check while idle, restarting it.")
+            self.healthy = False
+            self.restart()
+        except Exception as e:
+            print(f"Worker pool {self.name} failed its health check, restarting it: {e!r}")
+            self.healthy = False
+            if not isinstance(e, BrokenProcessPool):
+                self.restart()
+        return self.healthy
+
+    async def check_health_forever(self):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(config.worker_health_interval)
+
+    def warm(self):
+        """Submits one warm_up per worker. The executor spawns a process for each job that finds no idle worker, so
+        this starts them all."""
+        for _ in range(self.size):
+            self.executor.submit(warm_up)
+
+    def restart(self):
+        old_executor = self.executor
+        self.executor = self._make_executor()
+        old_executor.shutdown(wait=False)
+        self.warm()
+
+    def shutdown(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            self.health_task = None
+        self.executor.shutdown(wait=False)
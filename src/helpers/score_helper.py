@@ -0,0 +1,243 @@
+import asyncio
+import datetime
+
+import numpy as np
+import pymongo
+from pymongo.errors import PyMongoError
+
+from src.helpers.cache_helper import LRUCache
+from src.helpers.gap_helper import greedy_gap_points
+from src.helpers.sync_mongo_helper import get_client, get_guild_score_match
+from src.storage import config
+
+SCORE_WINDOW = datetime.timedelta(days=7)
+SCORE_GAP_SECONDS = 60
+BUCKET_SECONDS = 3600
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def bucket_of(timestamp):
+    return int((timestamp - EPOCH).total_seconds() // BUCKET_SECONDS)
+
+
+def week_start(timestamp):
+    """Midnight (UTC) on the Monday of timestamp's week."""
+    day_start = datetime.datetime(timestamp.year, timestamp.month, timestamp.day)
+    return day_start - datetime.timedelta(days=timestamp.weekday())
+
+
+class GuildScores:
+    """Weekly activity scores for one guild, kept up to date one message at a time.
+
+    A message scores a point if it was sent at least 60 seconds after the user's last scoring message (the same
+    greedy rule greedy_gap_points implements). Points are counted into hourly buckets so they can be dropped once
+    they're a week old, which means the window's oldest edge is only accurate to the hour."""
+    def __init__(self, excluded_channels=()):
+        self.excluded_channels = set(excluded_channels)
+        self.last_valid = {}
+        self.buckets = {}
+
+    def add(self, user_id, channel_id, timestamp):
+        if channel_id in self.excluded_channels:
+            return False
+        last_valid = self.last_valid.get(user_id)
+        if last_valid is not None and (timestamp - last_valid).total_seconds() < SCORE_GAP_SECONDS:
+            return False
+        self.last_valid[user_id] = timestamp
+        user_buckets = self.buckets.setdefault(user_id, {})
+        bucket = bucket_of(timestamp)
+        user_buckets[bucket] = user_buckets.get(bucket, 0) + 1
+        return True
+
+    def add_all(self, user_ids, timestamps):
+        """Adds a batch of messages, each user's in time order, to a GuildScores that's still empty: the same result
+        as calling add for each, but with the gap rule worked out by greedy_gap_points and the points binned in bulk.
+        Excluded channels aren't checked, so leave their messages out."""
+        points = greedy_gap_points(user_ids, timestamps, SCORE_GAP_SECONDS)
+        user_ids = np.asarray(user_ids, dtype=np.int64)[points]
+        if len(user_ids) == 0:
+            return
+        times = np.asarray(timestamps, dtype="datetime64[us]")[points]
+        buckets = (times - np.datetime64(EPOCH, "us")) // np.timedelta64(BUCKET_SECONDS, "s")
+        pairs, counts = np.unique(np.stack([user_ids, buckets]), axis=1, return_counts=True)
+        for (user_id, bucket), count in zip(pairs.T.tolist(), counts.tolist()):
+            user_buckets = self.buckets.setdefault(user_id, {})
+            user_buckets[bucket] = user_buckets.get(bucket, 0) + count
+        # Each user's last scoring message is their last point, which is their first one in reverse order.
+        unique_users, last_points = np.unique(user_ids[::-1], return_index=True)
+        for user_id, timestamp in zip(unique_users.tolist(), times[::-1][last_points].tolist()):
+            self.last_valid[user_id] = timestamp
+
+    def expire(self, now):
+        oldest_bucket = bucket_of(now - SCORE_WINDOW)
+        for user_id in list(self.buckets.keys()):
+            user_buckets = self.buckets[user_id]
+            for bucket in [bucket for bucket in user_buckets if bucket < oldest_bucket]:
+                del user_buckets[bucket]
+            if len(user_buckets) == 0:
+                # Their last scoring message is over a week old, so it can't affect the gap rule any more either.
+                del self.buckets[user_id]
+                self.last_valid.pop(user_id, None)
+
+    def score(self, user_id, now):
+        oldest_bucket = bucket_of(now - SCORE_WINDOW)
+        return sum(count for bucket, count in self.buckets.get(user_id, {}).items() if bucket >= oldest_bucket)
+
+    def scores(self, now):
+        self.expire(now)
+        list_of_tuples = [(user_id, sum(user_buckets.values())) for user_id, user_buckets in self.buckets.items()]
+        list_of_tuples.sort(key=lambda x: x[1], reverse=True)
+        return list_of_tuples
+
+
+def seed_guild_scores(guild_id, database="discord", since=None, until=None):
+    """Builds a guild's GuildScores from the stored messages sent from since up to (not including) until, by default
+    the past week. Runs in a worker process.
+
+    Bots and excluded channels are filtered out by the server, so only user_id and created_at are fetched."""
+    client = get_client()
+    discord_db = client[database]
+    if since is None:
+        since = datetime.datetime.utcnow() - SCORE_WINDOW
+    match, excluded_channels = get_guild_score_match(discord_db, guild_id, since, until)
+    guild_scores = GuildScores(excluded_channels)
+    # Sorted by user and then time, with times as milliseconds, is what greedy_gap_points handles fastest.
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"user_id": pymongo.ASCENDING, "created_at": pymongo.ASCENDING}},
+        {"$project": {"_id": 0, "user_id": 1, "created_at": {"$toLong": "$created_at"}}},
+    ]
+    user_ids = []
+    timestamps = []
+    for message in discord_db.messages.aggregate(pipeline, allowDiskUse=True, batchSize=10000):
+        user_ids.append(message["user_id"])
+        timestamps.append(message["created_at"])
+    guild_scores.add_all(np.array(user_ids, dtype=np.int64),
+                         np.array(timestamps, dtype=np.int64).astype("datetime64[ms]"))
+    return guild_scores
+
+
+class ScoreEngine:
+    """Weekly activity scores for every guild, so reading them costs O(users) rather than a scan of the week's
+    messages.
+
+    A guild is seeded from Mongo the first time its scores are read, and from then on every ingested message is
+    added as it arrives. Messages that arrive while the seed is running are held and added once it finishes; the
+    gap rule means one that the seed already counted can't be counted twice. Only the config.score_guild_cache_size
+    most recently read guilds are kept; the rest are seeded again if they're read again."""
+    def __init__(self, bot):
+        self.bot = bot
+        self.guilds = LRUCache(config.score_guild_cache_size, name="guild_score_state")
+        self.seeding = {}
+        self.held_messages = {}
+        # Finished leaderboards, and the ones being worked out right now so concurrent readers share them.
+        self.leaderboards = LRUCache(config.score_cache_size, config.score_cache_ttl, name="guild_scores")
+        self.computing = {}
+
+    def add_message(self, message):
+        if message.author.bot:
+            return
+        guild_id = message.guild.id
+        arguments = (message.author.id, message.channel.id, message.created_at)
+        # Adding a message isn't a read, so it doesn't keep an otherwise unused guild cached.
+        guild_scores = self.guilds.peek(guild_id)
+        if guild_scores is not None:
+            guild_scores.add(*arguments)
+        elif guild_id in self.held_messages:
+            self.held_messages[guild_id].append(arguments)
+
+    def invalidate(self, guild_id):
+        """Drops a guild's scores (say, after a channel is excluded) so the next read re-seeds them."""
+        self.guilds.pop(guild_id, None)
+        self.seeding.pop(guild_id, None)
+        self.held_messages.pop(guild_id, None)
+        self.leaderboards.pop(guild_id)
+        self.computing.pop(guild_id, None)
+
+    async def write_live_messages(self):
+        """Writes out messages that have been accepted but are still buffered (or spooled), so the seed query sees
+        everything from before its messages started being held."""
+        db_maintainer = self.bot.get_cog("DBMaintainer")
+        if db_maintainer is None:
+            return
+        await db_maintainer.message_buffer.flush()
+        if db_maintainer.spool.active:
+            try:
+                await db_maintainer.spool.replay()
+            except PyMongoError as e:
+                print(f"Couldn't replay the spool before seeding scores, spooled messages will be missing: {e}")
+
+    async def seed(self, guild_id):
+        try:
+            await self.write_live_messages()
+            guild_scores = await self.bot.analytics_pool.run(seed_guild_scores, guild_id)
+        except Exception:
+            if self.seeding.get(guild_id) is asyncio.current_task():
+                del self.seeding[guild_id]
+                self.held_messages.pop(guild_id, None)
+            raise
+        # Only keep the result if the guild wasn't invalidated while it was being seeded.
+        if self.seeding.get(guild_id) is asyncio.current_task():
+            for arguments in self.held_messages.pop(guild_id, []):
+                guild_scores.add(*arguments)
+            self.guilds[guild_id] = guild_scores
+            del self.seeding[guild_id]
+        return guild_scores
+
+    async def get_guild_scores(self, guild_id) -> GuildScores:
+        guild_scores = self.guilds.get(guild_id)
+        if guild_scores is not None:
+            return guild_scores
+        if guild_id not in self.seeding:
+            self.held_messages[guild_id] = []
+            self.seeding[guild_id] = self.bot.loop.create_task(self.seed(guild_id))
+        return await asyncio.shield(self.seeding[guild_id])
+
+    async def guild_scores(self, guild):
+        """(user_id, score) for the guild's current, non-bot members, highest first. Cached for
+        config.score_cache_ttl seconds."""
+        results = self.leaderboards.get(guild.id)
+        if results is not None:
+            return results
+        if guild.id not in self.computing:
+            self.computing[guild.id] = self.bot.loop.create_task(self.compute_guild_scores(guild))
+        return await asyncio.shield(self.computing[guild.id])
+
+    async def compute_guild_scores(self, guild):
+        try:
+            results = await self._compute_guild_scores(guild)
+            # As with seeding, a result worked out before an invalidation isn't cached.
+            if self.computing.get(guild.id) is asyncio.current_task():
+                self.leaderboards[guild.id] = results
+            return results
+        finally:
+            if self.computing.get(guild.id) is asyncio.current_task():
+                del self.computing[guild.id]
+
+    async def _compute_guild_scores(self, guild):
+        guild_scores = await self.get_guild_scores(guild.id)
+        return self.members_only(guild, guild_scores.scores(datetime.datetime.utcnow()))
+
+    @staticmethod
+    def members_only(guild, scores):
+        results = []
+        for user_id, score in scores:
+            member = guild.get_member(user_id)
+            if member is None or member.bot:
+                continue
+            results.append((user_id, score))
+        return results
+
+    async def week_scores(self, guild, start):
+        """(user_id, score) for the guild's current, non-bot members over the week from start, highest first. Worked
+        out from scratch rather than from the live scores, so it's the same however long after the week it runs."""
+        end = start + SCORE_WINDOW
+        await self.write_live_messages()
+        guild_scores = await self.bot.analytics_pool.run(seed_guild_scores, guild.id, since=start, until=end)
+        # Scores as of the week's end only count its own buckets.
+        return self.members_only(guild, guild_scores.scores(end))
+
+    async def user_score(self, member):
+        guild_scores = await self.get_guild_scores(member.guild.id)
+        return guild_scores.score(member.id, datetime.datetime.utcnow())
+
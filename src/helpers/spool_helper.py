@@ -0,0 +1,132 @@
+import asyncio
+import concurrent.futures
+import os
+import time
+
+from bson import json_util
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from src.storage import config
+
+
+class MessageSpool:
+    """Append-only local spool for message writes that couldn't be made to Mongo.
+
+    Each record is one line of extended JSON (so datetimes survive) in numbered segment files under
+    config.spool_path. Once something has been spooled, later writes are spooled too until replay() has loaded
+    everything back into Mongo, so writes reach the database in the order they happened.
+
+    All file I/O runs on the spool's one thread, so it doesn't block the event loop and records stay in order."""
+    def __init__(self, mongo, path=None):
+        self.mongo = mongo
+        self.path = path or config.spool_path
+        os.makedirs(self.path, exist_ok=True)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.current_file = None
+        self.current_size = 0
+        self.queued_writes = 0
+        self.replaying = False
+        self.active = len(self.segment_paths()) > 0
+
+    async def _run(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    def segment_paths(self):
+        return sorted(os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(".jsonl"))
+
+    def rotate(self):
+        if self.current_file is not None:
+            self.current_file.close()
+        self.current_file = open(os.path.join(self.path, f"{time.time_ns():020d}.jsonl"), 'a')
+        self.current_size = 0
+
+    def close_segment(self):
+        if self.current_file is not None:
+            self.current_file.close()
+            self.current_file = None
+
+    def close_segment_and_list(self):
+        self.close_segment()
+        return self.segment_paths()
+
+    async def append(self, kind, documents):
+        # Set before the write so anything after this is spooled behind it.
+        self.active = True
+        record = json_util.dumps({"kind": kind, "documents": documents}) + "\n"
+        self.queued_writes += 1
+        try:
+            await self._run(self._write, record)
+        finally:
+            self.queued_writes -= 1
+
+    def _write(self, record):
+        if self.current_file is None or self.current_size >= config.spool_segment_bytes:
+            self.rotate()
+        self.current_file.write(record)
+        self.current_file.flush()
+        os.fsync(self.current_file.fileno())
+        self.current_size += len(record)
+
+    @staticmethod
+    def _read_lines(segment_path):
+        with open(segment_path, 'r') as segment_file:
+            return segment_file.readlines()
+
+    async def replay(self):
+        """Loads every spooled segment into Mongo, oldest first. Messages are only inserted if they don't already
+        exist, so replaying a segment twice is harmless. Raises if Mongo is still unavailable."""
+        if self.replaying:
+            return 0
+        self.replaying = True
+        replayed = 0
+        try:
+            while True:
+                segment_paths = await self._run(self.close_segment_and_list)
+                if len(segment_paths) == 0:
+                    # A write queued behind the listing will be in the next one.
+                    if self.queued_writes > 0:
+                        continue
+                    self.active = False
+                    return replayed
+                for segment_path in segment_paths:
+                    replayed += await self.replay_segment(segment_path)
+                    await self._run(os.remove, segment_path)
+        finally:
+            self.replaying = False
+
+    async def replay_segment(self, segment_path):
+        replayed = 0
+        for line in await self._run(self._read_lines, segment_path):
+            try:
+                record = json_util.loads(line)
+            except ValueError:
+                # A partial line left behind by a crash mid-write.
+                continue
+            documents = record.get("documents", [])
+            if len(documents) == 0:
+                continue
+            if record.get("kind") == "unchecked":
+                # Messages whose channel's nostore flag wasn't known when they were spooled.
+                documents = await self.mongo.without_nostore(documents)
+            if record.get("kind") in ("messages", "unchecked") and len(documents) > 0:
+                requests = [UpdateOne({"_id": document["_id"]}, {"$setOnInsert": document}, upsert=True)
+                            for document in documents]
+                try:
+                    result = await self.mongo.discord_db.messages.bulk_write(requests, ordered=False)
+                    inserted_documents = [documents[index] for index in result.upserted_ids]
+                except BulkWriteError as e:
+                    print(f"Spool replay had {len(e.details.get('writeErrors', []))} write errors.")
+                    inserted_documents = [documents[upserted["index"]]
+                                          for upserted in e.details.get("upserted", [])]
+                await self.mongo.increment_rollups(inserted_documents)
+            elif record.get("kind") == "deleted":
+                await self.mongo.discord_db.messages.update_many({"_id": {"$in": documents}},
+                                                                 {"$set": {"deleted": True}})
+            elif record.get("kind") == "edits":
+                # Edits were spooled after the messages they edit, so those messages have been replayed by now.
+                # Reapplying an edit replaces it rather than adding it twice.
+                for edit in documents:
+                    await self.mongo.apply_edit(edit)
+            replayed += len(documents)
+        return replayed
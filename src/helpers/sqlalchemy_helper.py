@@ -6,6 +6,7 @@ from sqlalchemy import and_, desc, func
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from src.helpers.models.database_models import *
+from src.helpers.gap_helper import greedy_gap_scores
 from src.storage import config
 
 
@@ -195,8 +196,6 @@ class DatabaseHelper:
             session = self.session_creator()
             now = datetime.datetime.now()
             last_week = now - datetime.timedelta(days=7)
-            last_valid = {}
-            scores = {}
             # total_messages = {})
             query = session.query(Message.user_id,
                                   Message.timestamp).with_hint(Message,
@@ -206,17 +205,8 @@ class DatabaseHelper:
                                                                        Message.guild_id == guild_id,
                                                                        User.bot.is_(False),
                                                                        Channel.excluded_from_leaderboard == 0)
-            results = sorted(query.all(), key=lambda x: x.timestamp)
-            for row in results:
-                user_id = row.user_id
-                timestamp = row.timestamp
-                # total_messages[user_id] = total_messages.get(user_id, 0) + 1
-                if user_id not in last_valid:
-                    last_valid[user_id] = timestamp
-                    scores[user_id] = 1
-                elif (timestamp - last_valid[user_id]).total_seconds() >= 60:
-                    last_valid[user_id] = timestamp
-                    scores[user_id] += 1
+            results = query.all()
+            scores = greedy_gap_scores([row.user_id for row in results], [row.timestamp for row in results])
             list_of_tuples = [(user_id, score) for user_id, score in scores.items()]
             list_of_tuples.sort(key=lambda x: x[1], reverse=True)
             self.session_creator.remove()
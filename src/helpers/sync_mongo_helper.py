@@ -1,20 +1,30 @@
 import pymongo
-import datetime
 from src.storage import config
 
 
+# Set in analytics worker processes by init_worker, so every job in a worker shares one connection pool.
+worker_client = None
+
+
+def init_worker():
+    global worker_client
+    worker_client = pymongo.MongoClient(config.mongo_connection_uri)
+
+
+def ping_worker():
+    get_client().admin.command("ping")
+    return True
+
+
 def get_client():
+    if worker_client is not None:
+        return worker_client
     client = pymongo.MongoClient(config.mongo_connection_uri)
     return client
 
 
-def get_guild_score(guild_id):
-    client = get_client()
-    discord_db = client.discord
-    now = datetime.datetime.now()
-    last_week = now - datetime.timedelta(days=7)
-    last_valid = {}
-    scores = {}
+def get_member_ids(discord_db, guild_id):
+    """Ids of the guild's stored members that aren't bots."""
     guild_members_pipeline = [
         {
             "$match": {
@@ -39,43 +49,49 @@ def get_guild_score(guild_id):
             "$project": {"_id": "$_id"}
         }
     ]
-    excluded_channels = discord_db.channels.find({"excluded": True, "guild_id": guild_id}).distinct("_id")
     aggregation = discord_db.members.aggregate(guild_members_pipeline)
-    member_list = set(x.get("_id").get("user_id") for x in aggregation)
-    query = discord_db.messages.find({"created_at": {"$gt": last_week}, "guild_id": guild_id})
-    query.sort("created_at", pymongo.ASCENDING)
-    for message in query:
-        user_id = message.get("user_id")
-        timestamp = message.get("created_at")
-        channel_id = message.get("channel_id")
-        if user_id not in member_list or channel_id in excluded_channels:
-            continue
-        if user_id not in last_valid:
-            last_valid[user_id] = timestamp
-            scores[user_id] = 1
-        elif (timestamp - last_valid[user_id]).total_seconds() >= 60:
-            last_valid[user_id] = timestamp
-            scores[user_id] += 1
-    list_of_tuples = [(user_id, score) for user_id, score in scores.items()]
-    list_of_tuples.sort(key=lambda x: x[1], reverse=True)
-    return list_of_tuples
+    return set(x.get("_id").get("user_id") for x in aggregation)
+
+
+def get_bot_ids(discord_db, guild_id):
+    """Ids of the guild's stored members (past or present) that are bots."""
+    guild_bots_pipeline = [
+        {
+            "$match": {
+                "_id.guild_id": guild_id
+            }
+        },
+        {
+            "$lookup": {
+                "from": "users",
+                "localField": "_id.user_id",
+                "foreignField": "_id",
+                "as": "user"
+            }
+        },
+        {
+            "$match": {
+                "user.bot": True
+            }
+        },
+        {
+            "$project": {"_id": "$_id"}
+        }
+    ]
+    aggregation = discord_db.members.aggregate(guild_bots_pipeline)
+    return set(x.get("_id").get("user_id") for x in aggregation)
+
 
+def get_guild_score_match(discord_db, guild_id, since, until=None):
+    """The filter for messages that count towards a guild's scores, with bots and excluded channels left out by
+    the server, sent from since up to (not including) until. Also returns the excluded channel ids.
 
-def get_user_score(user_id, guild_id):
-    client = get_client()
-    discord_db = client.discord
-    now = datetime.datetime.now()
-    last_week = now - datetime.timedelta(days=7)
-    score = 0
-    last_message = datetime.datetime(2015, 1, 1)
+    Bots are few, so they're the ones listed; messages from people who have since left are still matched, and
+    left out when the scores are read."""
     excluded_channels = discord_db.channels.find({"excluded": True, "guild_id": guild_id}).distinct("_id")
-    query = discord_db.messages.find({"created_at": {"$gt": last_week}, "guild_id": guild_id, "user_id": user_id})
-    for message in query:
-        timestamp = message.get("created_at")
-        channel_id = message.get("channel_id")
-        if channel_id in excluded_channels:
-            continue
-        if (timestamp - last_message).total_seconds() >= 60:
-            last_message = timestamp
-            score += 1
-    return score
+    bot_ids = get_bot_ids(discord_db, guild_id)
+    match = {"guild_id": guild_id, "created_at": {"$gte": since}, "user_id": {"$nin": list(bot_ids)},
+             "channel_id": {"$nin": excluded_channels}}
+    if until is not None:
+        match["created_at"]["$lt"] = until
+    return match, excluded_channels
@@ -0,0 +1,74 @@
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from src.storage import config
+
+TIMESTAMP_DTYPE = np.dtype("datetime64[s]")
+
+
+class SharedTimestamps:
+    """A growable datetime64[s] array kept in shared memory, so a worker process can read millions of timestamps
+    without them being pickled.
+
+    It pickles as just its shared memory name and length; unpickling (in the worker) attaches to the same memory. The
+    process that created it unlinks the memory on close(), anyone else only detaches."""
+    def __init__(self, capacity=None):
+        self.capacity = capacity or config.timestamp_initial_capacity
+        self.shared_memory = SharedMemory(create=True, size=self.capacity * TIMESTAMP_DTYPE.itemsize)
+        self.length = 0
+        self.owner = True
+
+    def __getstate__(self):
+        return {"name": self.shared_memory.name, "capacity": self.capacity, "length": self.length}
+
+    def __setstate__(self, state):
+        self.shared_memory = SharedMemory(name=state["name"])
+        self.capacity = state["capacity"]
+        self.length = state["length"]
+        self.owner = False
+
+    def _view(self, shared_memory, capacity):
+        return np.ndarray((capacity,), dtype=TIMESTAMP_DTYPE, buffer=shared_memory.buf)
+
+    def extend(self, timestamps):
+        timestamps = np.asarray(timestamps, dtype=TIMESTAMP_DTYPE)
+        needed = self.length + len(timestamps)
+        if needed > self.capacity:
+            self._grow(max(needed, self.capacity * 2))
+        view = self._view(self.shared_memory, self.capacity)
+        view[self.length:needed] = timestamps
+        del view
+        self.length = needed
+
+    def _grow(self, capacity):
+        new_memory = SharedMemory(create=True, size=capacity * TIMESTAMP_DTYPE.itemsize)
+        new_view = self._view(new_memory, capacity)
+        old_view = self._view(self.shared_memory, self.capacity)
+        new_view[:self.length] = old_view[:self.length]
+        # The views have to go before the memory under them can be closed.
+        del new_view, old_view
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+        self.shared_memory = new_memory
+        self.capacity = capacity
+
+    def to_array(self, dtype=TIMESTAMP_DTYPE):
+        """A copy of the timestamps as an ordinary array, which stays valid after close()."""
+        view = self._view(self.shared_memory, self.capacity)
+        array = view[:self.length].astype(dtype)
+        del view
+        return array
+
+    def latest(self):
+        if self.length == 0:
+            return None
+        view = self._view(self.shared_memory, self.capacity)
+        latest = int(view[:self.length].max().astype(np.int64))
+        del view
+        return latest
+
+    def close(self):
+        self.shared_memory.close()
+        if self.owner:
+            self.shared_memory.unlink()
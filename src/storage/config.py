@@ -91,6 +91,75 @@ limit_amount = 7
 limit_period_days = 7
 
 
+# Settings for the message write-behind buffer
+message_flush_interval_ms = 500
+message_flush_size = 200
+delete_flush_interval_ms = 250
+delete_flush_size = 1000
+message_rate_window = 10
+
+# Settings for the local spool used when Mongo is slow or unavailable
+mongo_slow_timeout = 5
+spool_path = os.path.join(os.getcwd(), "spool")
+spool_segment_bytes = 16 * 1024 * 1024
+spool_replay_interval = 30
+
+# Settings for the cache of guilds, channels, users and members known to be stored
+known_entity_cache_size = 50000
+known_entity_ttl = 3600
+bulk_sync_chunk_size = 1000
+
+# Leave default-valued fields (empty embeds/edits/mentions, deleted=False...) out of new message documents
+compact_messages = False
+compact_batch_size = 1000
+
+# Settings for back-filling channel history (load_stats)
+backfill_concurrency = 4
+# Back-fill pauses while live messages arrive faster than this many a second (averaged over message_rate_window
+# seconds), or while live messages are waiting and the last flush took longer than backfill_live_flush_latency seconds.
+backfill_live_rate = 5
+backfill_live_flush_latency = 1
+backfill_yield_interval = 0.5
+backfill_progress_debounce = 2
+backfill_progress_save_interval = 30
+
+# Settings for the worker pools (analytics runs the sync_mongo_helper queries, render draws graphs and images)
+analytics_pool_size = 2
+render_pool_size = 2
+render_pool_max_queue = 16
+# Places in the render queue that background work (like the Hypixel updates) can't take, kept for user commands
+render_pool_reserved = 8
+worker_health_interval = 60
+worker_health_timeout = 30
+
+# Settings for the cache of computed leaderboards (and the per-guild state they're computed from)
+score_guild_cache_size = 1000
+score_cache_size = 256
+score_cache_ttl = 60
+
+# Settings for the cache of resolved display names
+name_cache_size = 10000
+name_cache_ttl = 300
+
+# Settings for weekly leaderboard snapshots
+leaderboard_snapshot_size = 50
+
+# Settings for streaming raw message timestamps into shared memory for graphs
+timestamp_batch_size = 10000
+timestamp_initial_capacity = 65536
+
+# Settings for the cache of rendered stats graphs
+graph_cache_path = os.path.join(os.getcwd(), "graph_cache")
+graph_cache_size = 64
+graph_cache_ttl = 3600
+graph_cache_disk_files = 1000
+graph_cache_disk_trim = 100
+
+# Settings for re-counting message rollups. Every rollup_recount_interval seconds, the last rollup_recount_days full
+# days of each guild's rollups are counted again from its messages, to put right any increments that were lost.
+rollup_recount_interval = 3 * 3600
+rollup_recount_days = 2
+
 # Settings for purge
 purge_max = 40
 purge_all = -1  # DO NOT CHANGE THIS FOR FEAR OF DEATH
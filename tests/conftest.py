@@ -0,0 +1,17 @@
+"""src.storage.config imports src.storage.token, which holds the bot's secrets and is never committed. When it isn't
+there, an empty stand-in lets the tests import config (and everything that imports it) without connecting anywhere."""
+import importlib.util
+import sys
+import types
+
+import src.storage
+
+if importlib.util.find_spec("src.storage.token") is None:
+    token = types.ModuleType("src.storage.token")
+    token.token = ""
+    token.dev_token = ""
+    token.mongo_user = ""
+    token.mongo_password = ""
+    token.auth_db = ""
+    sys.modules["src.storage.token"] = token
+    src.storage.token = token
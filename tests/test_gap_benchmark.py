@@ -0,0 +1,72 @@
+"""pytest-benchmark comparison of greedy_gap_scores with the old scoring loop on a week of a million messages.
+
+Each gets the messages the way its caller gets them: the loop as datetimes in time order (as the old find() returned
+them), the kernel as arrays sorted by user and then time (as seed_guild_scores builds them). The test names and each
+result's extra_info say which. Compare the two with --benchmark-group-by=group; test_kernel_speedup checks the kernel
+is at least SPEEDUP times faster."""
+import datetime
+import random
+
+import numpy as np
+import pytest
+
+from src.helpers.gap_helper import greedy_gap_scores
+from tests.test_gap_helper import loop_scores
+
+pytest.importorskip("pytest_benchmark")
+
+MESSAGE_COUNT = 1000000
+USER_COUNT = 2000
+SPEEDUP = 10
+
+LOOP_INPUT = "lists of user ids and datetimes, in time order"
+KERNEL_INPUT = "int64 user id and datetime64[ms] arrays, sorted by user and then time"
+
+mean_seconds = {}
+
+
+@pytest.fixture(scope="module")
+def week_of_messages():
+    random.seed(0)
+    # A few very active users and a long tail: the nth most active user sends 1/n as much as the most active one.
+    user_ids = np.array(random.choices(range(USER_COUNT), weights=[1 / (rank + 1) for rank in range(USER_COUNT)],
+                                       k=MESSAGE_COUNT), dtype=np.int64) * 1000003 + 700000000000000000
+    offsets = np.array([random.randrange(7 * 24 * 3600 * 1000) for _ in range(MESSAGE_COUNT)], dtype=np.int64)
+    timestamps = np.datetime64(datetime.datetime(2021, 6, 1), "ms") + offsets.astype("timedelta64[ms]")
+    in_time_order = np.argsort(timestamps, kind="stable")
+    by_user = np.lexsort((timestamps, user_ids))
+    return {
+        "loop": (user_ids[in_time_order].tolist(), timestamps[in_time_order].astype("datetime64[us]").tolist()),
+        "kernel": (user_ids[by_user], timestamps[by_user]),
+    }
+
+
+def record_mean(benchmark, name):
+    if benchmark.stats is not None:
+        mean_seconds[name] = benchmark.stats.stats.mean
+
+
+@pytest.mark.benchmark(group="greedy-gap-1M")
+def test_loop_time_ordered(benchmark, week_of_messages):
+    benchmark.extra_info["input"] = LOOP_INPUT
+    benchmark.pedantic(loop_scores, args=week_of_messages["loop"], rounds=3, warmup_rounds=1)
+    record_mean(benchmark, "loop")
+
+
+@pytest.mark.benchmark(group="greedy-gap-1M")
+def test_kernel_sorted_by_user(benchmark, week_of_messages):
+    benchmark.extra_info["input"] = KERNEL_INPUT
+    scores = benchmark.pedantic(greedy_gap_scores, args=week_of_messages["kernel"], rounds=10, warmup_rounds=1)
+    record_mean(benchmark, "kernel")
+    assert scores == loop_scores(*week_of_messages["loop"])
+
+
+def test_kernel_speedup():
+    if "loop" not in mean_seconds or "kernel" not in mean_seconds:
+        pytest.skip("Needs both benchmarks to have run with benchmarking enabled.")
+    speedup = mean_seconds["loop"] / mean_seconds["kernel"]
+    print(f"\nKernel ({KERNEL_INPUT}): {mean_seconds['kernel'] * 1000:.1f}ms mean\n"
+          f"Loop ({LOOP_INPUT}): {mean_seconds['loop'] * 1000:.1f}ms mean\n"
+          f"Speedup: {speedup:.1f}x")
+    assert speedup >= SPEEDUP, (f"The kernel ({KERNEL_INPUT}) is only {speedup:.1f}x faster than the loop "
+                                f"({LOOP_INPUT}), not {SPEEDUP}x.")
@@ -0,0 +1,118 @@
+import datetime
+import random
+
+import numpy as np
+import pytest
+
+from src.helpers import gap_helper
+from src.helpers.gap_helper import greedy_gap_points, greedy_gap_scores
+
+START = datetime.datetime(2021, 6, 1)
+
+
+def loop_points(user_ids, timestamps, gap_seconds=60):
+    """The message-by-message greedy rule the kernel replaces. Expects messages in time order."""
+    last_valid = {}
+    points = []
+    for user_id, timestamp in zip(user_ids, timestamps):
+        if user_id not in last_valid or (timestamp - last_valid[user_id]).total_seconds() >= gap_seconds:
+            last_valid[user_id] = timestamp
+            points.append(True)
+        else:
+            points.append(False)
+    return points
+
+
+def loop_scores(user_ids, timestamps, gap_seconds=60):
+    """The old scoring loop, as it was in get_guild_score."""
+    last_valid = {}
+    scores = {}
+    for user_id, timestamp in zip(user_ids, timestamps):
+        if user_id not in last_valid:
+            last_valid[user_id] = timestamp
+            scores[user_id] = 1
+        elif (timestamp - last_valid[user_id]).total_seconds() >= gap_seconds:
+            last_valid[user_id] = timestamp
+            scores[user_id] += 1
+    return scores
+
+
+def random_messages(seed, message_count, user_count, span_seconds, microseconds=False):
+    """Messages in time order. Whole seconds over a short span give plenty of ties and gaps of exactly 60s."""
+    random.seed(seed)
+    messages = []
+    for _ in range(message_count):
+        offset = datetime.timedelta(seconds=random.randrange(span_seconds),
+                                    microseconds=random.randrange(1000000) if microseconds else 0)
+        messages.append((random.randrange(user_count) * 1000003 + 700000000000000000, START + offset))
+    messages.sort(key=lambda message: message[1])
+    return [message[0] for message in messages], [message[1] for message in messages]
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("message_count,user_count,span_seconds,microseconds", [
+    (50, 1, 600, False),
+    (500, 5, 1200, False),
+    (5000, 50, 7 * 24 * 3600, False),
+    (5000, 20, 24 * 3600, True),
+])
+def test_matches_loop(seed, message_count, user_count, span_seconds, microseconds):
+    user_ids, timestamps = random_messages(seed, message_count, user_count, span_seconds, microseconds)
+    assert greedy_gap_points(user_ids, timestamps).tolist() == loop_points(user_ids, timestamps)
+    assert greedy_gap_scores(user_ids, timestamps) == loop_scores(user_ids, timestamps)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_small_search_chunks(seed, monkeypatch):
+    # The searches for a chunk's targets run into the next chunk's sources, and past the last user's messages.
+    monkeypatch.setattr(gap_helper, "SEARCH_CHUNK_SIZE", 7)
+    user_ids, timestamps = random_messages(seed, 2000, 5, 3 * 3600)
+    assert greedy_gap_points(user_ids, timestamps).tolist() == loop_points(user_ids, timestamps)
+
+
+def test_gap_boundaries():
+    offsets = [0, 60, 119.999999, 120, 120, 179.999999, 180, 239.999999]
+    timestamps = [START + datetime.timedelta(seconds=offset) for offset in offsets]
+    user_ids = [1] * len(offsets)
+    assert greedy_gap_points(user_ids, timestamps).tolist() == [True, True, False, True, False, False, True, False]
+    assert greedy_gap_scores(user_ids, timestamps) == {1: 4}
+
+
+def test_ties_score_the_first_message_given():
+    timestamps = [START, START, START + datetime.timedelta(seconds=60), START + datetime.timedelta(seconds=60)]
+    assert greedy_gap_points([1, 1, 1, 1], timestamps).tolist() == [True, False, True, False]
+    assert greedy_gap_points([1, 2, 2, 1], timestamps).tolist() == [True, True, True, True]
+
+
+def test_channels_make_no_difference():
+    # Same user in two channels 30s apart: only the first scores, as in the loop, which never looked at channels.
+    timestamps = [START, START + datetime.timedelta(seconds=30), START + datetime.timedelta(seconds=61)]
+    assert greedy_gap_scores([1, 1, 1], timestamps) == {1: 2}
+
+
+def test_unsorted_input_scores_the_same():
+    user_ids, timestamps = random_messages(0, 2000, 10, 3600)
+    order = np.random.default_rng(0).permutation(len(user_ids))
+    shuffled_points = greedy_gap_points(np.asarray(user_ids)[order], np.asarray(timestamps)[order])
+    points = np.empty(len(user_ids), dtype=bool)
+    points[order] = shuffled_points
+    assert greedy_gap_scores(user_ids, timestamps) == loop_scores(user_ids, timestamps)
+    assert points.sum() == sum(loop_points(user_ids, timestamps))
+
+
+def test_sorted_by_user_scores_the_same():
+    user_ids, timestamps = random_messages(1, 2000, 10, 3600)
+    order = np.lexsort((np.asarray(timestamps), np.asarray(user_ids)))
+    points = greedy_gap_points(np.asarray(user_ids)[order], np.asarray(timestamps)[order])
+    assert points.tolist() == np.asarray(loop_points(user_ids, timestamps))[order].tolist()
+
+
+def test_datetime64_milliseconds():
+    user_ids, timestamps = random_messages(2, 2000, 10, 3600, microseconds=True)
+    milliseconds = np.asarray(timestamps, dtype="datetime64[ms]")
+    assert greedy_gap_points(user_ids, milliseconds).tolist() == loop_points(user_ids, milliseconds.tolist())
+
+
+def test_empty():
+    assert greedy_gap_points([], []).tolist() == []
+    assert greedy_gap_scores([], []) == {}
@@ -0,0 +1,98 @@
+"""Benchmarks the ScoreEngine seed (server-side filtering, user_id and created_at only) against the old
+full-document scoring, on a synthetic guild with a million messages.
+
+Only runs when SCORE_BENCHMARK_MONGO_URI points at a scratch Mongo server. It writes a throwaway database there and
+drops only that database afterwards."""
+import datetime
+import os
+import random
+import uuid
+
+import pytest
+
+MONGO_URI = os.environ.get("SCORE_BENCHMARK_MONGO_URI")
+if MONGO_URI is None:
+    pytest.skip("SCORE_BENCHMARK_MONGO_URI isn't set.", allow_module_level=True)
+pytest.importorskip("pytest_benchmark")
+
+import pymongo  # noqa: E402
+
+from src.helpers import sync_mongo_helper  # noqa: E402
+from src.helpers.score_helper import seed_guild_scores  # noqa: E402
+
+GUILD_ID = 1
+MESSAGE_COUNT = int(os.environ.get("SCORE_BENCHMARK_MESSAGES", 1000000))
+USER_COUNT = 2000
+CHANNEL_COUNT = 50
+
+
+def make_benchmark_guild(discord_db):
+    random.seed(GUILD_ID)
+    now = datetime.datetime.utcnow()
+    discord_db.users.insert_many([{"_id": user_id, "name": f"user{user_id}", "bot": user_id % 50 == 0}
+                                  for user_id in range(USER_COUNT)])
+    discord_db.members.insert_many([{"_id": {"user_id": user_id, "guild_id": GUILD_ID}, "deleted": False}
+                                    for user_id in range(USER_COUNT)])
+    discord_db.channels.insert_many([{"_id": channel_id, "guild_id": GUILD_ID, "excluded": channel_id % 10 == 0}
+                                     for channel_id in range(CHANNEL_COUNT)])
+    discord_db.messages.create_index([("guild_id", pymongo.ASCENDING), ("created_at", pymongo.ASCENDING)])
+    batch = []
+    for message_id in range(MESSAGE_COUNT):
+        batch.append({"_id": message_id, "guild_id": GUILD_ID,
+                      "user_id": int(random.paretovariate(1.2)) % USER_COUNT,
+                      "channel_id": random.randrange(CHANNEL_COUNT),
+                      # Whole seconds, and clear of the week's edge, so both paths see exactly the same messages.
+                      "created_at": now - datetime.timedelta(seconds=random.randrange(1, int(6.9 * 24 * 3600))),
+                      "content": "x" * random.randrange(200), "embeds": [], "edits": [], "deleted": False})
+        if len(batch) == 10000:
+            discord_db.messages.insert_many(batch, ordered=False)
+            batch = []
+    if len(batch) > 0:
+        discord_db.messages.insert_many(batch, ordered=False)
+
+
+def full_document_scores(discord_db):
+    """How guild scores were worked out before: every field of every message, filtered in Python."""
+    last_week = datetime.datetime.utcnow() - datetime.timedelta(days=7)
+    last_valid = {}
+    scores = {}
+    excluded_channels = discord_db.channels.find({"excluded": True, "guild_id": GUILD_ID}).distinct("_id")
+    member_list = sync_mongo_helper.get_member_ids(discord_db, GUILD_ID)
+    query = discord_db.messages.find({"created_at": {"$gt": last_week}, "guild_id": GUILD_ID})
+    query.sort("created_at", pymongo.ASCENDING)
+    for message in query:
+        user_id = message.get("user_id")
+        timestamp = message.get("created_at")
+        if user_id not in member_list or message.get("channel_id") in excluded_channels:
+            continue
+        if user_id not in last_valid:
+            last_valid[user_id] = timestamp
+            scores[user_id] = 1
+        elif (timestamp - last_valid[user_id]).total_seconds() >= 60:
+            last_valid[user_id] = timestamp
+            scores[user_id] += 1
+    return scores
+
+
+@pytest.fixture(scope="module")
+def benchmark_database():
+    client = pymongo.MongoClient(MONGO_URI)
+    # seed_guild_scores uses the worker client when there is one, which keeps it off config.mongo_connection_uri.
+    sync_mongo_helper.worker_client = client
+    database = f"score_benchmark_{uuid.uuid4().hex}"
+    make_benchmark_guild(client[database])
+    yield database
+    client.drop_database(database)
+    sync_mongo_helper.worker_client = None
+    client.close()
+
+
+def test_full_documents(benchmark, benchmark_database):
+    discord_db = sync_mongo_helper.worker_client[benchmark_database]
+    benchmark.pedantic(full_document_scores, args=(discord_db,), rounds=3)
+
+
+def test_seed_matches_full_documents(benchmark, benchmark_database):
+    discord_db = sync_mongo_helper.worker_client[benchmark_database]
+    guild_scores = benchmark.pedantic(seed_guild_scores, args=(GUILD_ID, benchmark_database), rounds=3)
+    assert dict(guild_scores.scores(datetime.datetime.utcnow())) == full_document_scores(discord_db)
@@ -0,0 +1,51 @@
+import datetime
+import random
+
+import numpy as np
+import pytest
+
+from src.helpers import score_helper
+
+START = datetime.datetime(2021, 6, 1)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_add_all_matches_add(seed):
+    random.seed(seed)
+    messages = sorted(((random.randrange(20), START + datetime.timedelta(seconds=random.randrange(3 * 24 * 3600),
+                                                                          microseconds=random.randrange(2) * 500000))
+                       for _ in range(5000)), key=lambda message: message[1])
+    one_at_a_time = score_helper.GuildScores()
+    for user_id, timestamp in messages:
+        one_at_a_time.add(user_id, None, timestamp)
+    in_bulk = score_helper.GuildScores()
+    in_bulk.add_all([message[0] for message in messages], [message[1] for message in messages])
+    assert in_bulk.buckets == one_at_a_time.buckets
+    assert in_bulk.last_valid == one_at_a_time.last_valid
+
+
+def test_add_all_sorted_by_user():
+    random.seed(10)
+    messages = sorted((random.randrange(20), START + datetime.timedelta(milliseconds=random.randrange(24 * 3600000)))
+                      for _ in range(5000))
+    one_at_a_time = score_helper.GuildScores()
+    for user_id, timestamp in messages:
+        one_at_a_time.add(user_id, None, timestamp)
+    in_bulk = score_helper.GuildScores()
+    in_bulk.add_all(np.array([message[0] for message in messages]),
+                    np.array([message[1] for message in messages], dtype="datetime64[ms]"))
+    assert in_bulk.buckets == one_at_a_time.buckets
+    assert in_bulk.last_valid == one_at_a_time.last_valid
+
+
+def test_add_all_then_add():
+    guild_scores = score_helper.GuildScores()
+    guild_scores.add_all([1, 1], [START, START + datetime.timedelta(seconds=30)])
+    assert not guild_scores.add(1, None, START + datetime.timedelta(seconds=59))
+    assert guild_scores.add(1, None, START + datetime.timedelta(seconds=60))
+
+
+def test_add_all_empty():
+    guild_scores = score_helper.GuildScores()
+    guild_scores.add_all([], [])
+    assert guild_scores.buckets == {} and guild_scores.last_valid == {}